@@ -0,0 +1,201 @@
+""" Replays a synthetic class (see benchmarks/synthetic_progsnap.py) against the
+server, and reports the latency percentiles and throughput of each endpoint,
+and how long each model rebuild took as the data grew.
+
+By default, the server is run in this process, using Flask's test client, with
+its data in a temporary folder (and models rebuilt from the replayed events),
+so nothing in server/data is changed. With --url, the events are instead sent
+to a running server, which logs them to its own database.
+
+Usage (from the repository root):
+    python -m benchmarks.load_test --students 100 --problems 5 --rate 200 --concurrency 8
+"""
+
+import sys, os
+import argparse
+import json
+import tempfile
+import threading
+import time
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import yaml
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from benchmarks.synthetic_progsnap import generate_events, get_problem_ids, STARTER_CODE
+
+ENDPOINTS = {
+    "FileEdit": "/FileEdit/",
+    "Submit": "/Submit/",
+    "Run.Program": "/Run.Program/",
+}
+
+class InProcessClient:
+    """ Sends requests to server.main's Flask app, using a test client per thread. """
+
+    def __init__(self, config):
+        self.directory = tempfile.TemporaryDirectory(prefix="simpleaif-load-test-")
+        config = dict(config, data_directory=self.directory.name)
+        config_path = os.path.join(self.directory.name, "config.yaml")
+        with open(config_path, "w") as file:
+            yaml.safe_dump(config, file)
+        os.environ["SIMPLEAIF_CONFIG"] = config_path
+        import server.main
+        self.server = server.main
+        self.local = threading.local()
+
+    def post(self, path, body):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.server.app.test_client()
+        response = client.post(path, json=body)
+        return response.status_code
+
+    def get_stats(self):
+        return self.server.app.test_client().get("/X-Stats/").json
+
+    def wait_for_builds(self):
+        if self.server.fb_gen.build_scheduler is not None:
+            self.server.fb_gen.build_scheduler.wait()
+
+    def close(self):
+        for logger in self.server.fb_gen.loggers.values():
+            if logger.journal is not None:
+                logger.journal.close()
+            logger.close()
+        self.directory.cleanup()
+
+class HTTPClient:
+    """ Sends requests to a running server. """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def post(self, path, body):
+        request = urllib.request.Request(
+            self.url + path, data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"}, method="POST"
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def get_stats(self):
+        try:
+            with urllib.request.urlopen(self.url + "/X-Stats/") as response:
+                return json.loads(response.read())
+        except urllib.error.URLError:
+            return None
+
+    def wait_for_builds(self):
+        pass
+
+    def close(self):
+        pass
+
+def load_server_config(args):
+    path = os.path.join(os.path.dirname(__file__), '..', 'server', 'config.default.yaml')
+    with open(path) as file:
+        config = yaml.safe_load(file)
+    config["log_database"] = "LoadTest"
+    config["build"].update({
+        "model_database": None,
+        "rebuild_models": True,
+        "min_correct_count_for_feedback": args.min_correct,
+        "increment": args.increment,
+        "language": "python",
+    })
+    config["conditions"]["assignment"] = "all_intervention"
+    return config
+
+def replay(client, events, rate, concurrency):
+    """ Sends each event to its endpoint, at the given rate (in requests per
+    second, or as fast as possible if 0), with up to concurrency requests at
+    once. Returns the latencies (in seconds) and number of errors of each
+    endpoint, and the total duration.
+    """
+    latencies = {endpoint: [] for endpoint in ENDPOINTS.values()}
+    errors = {endpoint: 0 for endpoint in ENDPOINTS.values()}
+    lock = threading.Lock()
+
+    def send(event, scheduled):
+        path = ENDPOINTS[event["EventType"]]
+        body = {key: value for key, value in event.items() if key not in ("EventType", "Time")}
+        # With a fixed rate, time spent waiting for a free thread counts as latency
+        start = scheduled if scheduled is not None else time.perf_counter()
+        try:
+            ok = client.post(path, body) == 200
+        except Exception:
+            ok = False
+        latency = time.perf_counter() - start
+        with lock:
+            latencies[path].append(latency)
+            if not ok:
+                errors[path] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i, event in enumerate(events):
+            scheduled = None
+            if rate > 0:
+                # Requests are sent on schedule, even if earlier ones haven't finished
+                scheduled = start + i / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(send, event, scheduled)
+    return latencies, errors, time.perf_counter() - start
+
+def print_report(latencies, errors, duration):
+    print(f"\n{'endpoint':>14} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    rows = list(latencies.items())
+    rows.append(("all", [latency for values in latencies.values() for latency in values]))
+    for endpoint, values in rows:
+        if len(values) == 0:
+            continue
+        n_errors = sum(errors.values()) if endpoint == "all" else errors[endpoint]
+        p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1000
+        print(f"{endpoint:>14} {len(values):>9} {n_errors:>7} {len(values) / duration:>8.1f} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f}")
+    print(f"Sent in {duration:.1f}s")
+
+def print_builds(stats):
+    builds = stats.get("recent_builds", []) if stats is not None else []
+    if len(builds) == 0:
+        print("\nNo model rebuilds were reported")
+        return
+    print(f"\n{'problem':>14} {'correct':>8} {'build s':>8}")
+    for build in builds:
+        print(f"{build['ProblemID']:>14} {build['correct_count']:>8} {build['seconds']:>8.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=100)
+    parser.add_argument("--problems", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rate", type=float, default=0, help="requests per second (default: as fast as possible)")
+    parser.add_argument("--concurrency", type=int, default=8, help="maximum number of requests in flight")
+    parser.add_argument("--url", help="send requests to the server at this URL, rather than in this process")
+    parser.add_argument("--min-correct", type=int, default=10, help="correct submissions needed to build a model (in-process only)")
+    parser.add_argument("--increment", type=int, default=10, help="correct submissions between rebuilds (in-process only)")
+    args = parser.parse_args()
+
+    events = generate_events(args.students, args.problems, args.seed)
+    print(f"Replaying {len(events)} events from {args.students} students on {args.problems} problems")
+    client = HTTPClient(args.url) if args.url is not None else InProcessClient(load_server_config(args))
+    try:
+        for problem_id in get_problem_ids(args.problems):
+            client.post("/X-SetStarterCode/", {"ProblemID": problem_id, "StarterCode": STARTER_CODE})
+        latencies, errors, duration = replay(client, events, args.rate, args.concurrency)
+        print_report(latencies, errors, duration)
+        client.wait_for_builds()
+        print_builds(client.get_stats())
+    finally:
+        client.close()
+
+if __name__ == '__main__':
+    main()
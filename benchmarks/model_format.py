@@ -0,0 +1,63 @@
+""" Compares the size and load time of models stored with pickle and with the
+compact model format (shared/model_format.py), for a progress model and a
+classifier trained on a large, synthetic problem.
+
+Usage (from the repository root):
+    python -m benchmarks.model_format --solutions 2000
+"""
+
+import sys, os
+import argparse
+import pickle
+import random
+import time
+import warnings
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from shared.preprocess import SimpleAIFBuilder
+from shared import model_format
+from benchmarks.progress_fit_memory import generate_solutions
+
+def median_load_ms(load, blob, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        load(blob)
+        durations.append(time.perf_counter() - start)
+    return np.median(durations) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--solutions", type=int, default=2000, help="number of synthetic correct solutions")
+    parser.add_argument("--repeats", type=int, default=20, help="number of times each model is loaded")
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    rnd = random.Random(1)
+    correct = generate_solutions(args.solutions)
+    # Incorrect solutions are missing some of their lines
+    incorrect = [
+        "\n".join(line for line in solution.splitlines() if rnd.random() < 0.7)
+        for solution in generate_solutions(args.solutions, seed=1)
+    ]
+    builder = SimpleAIFBuilder("benchmark")
+    builder.get_starter_code = lambda: "def solve(data):\n    pass"
+    builder.X_train = pd.Series(correct + incorrect)
+    builder.y_train = pd.Series([True] * len(correct) + [False] * len(incorrect))
+
+    models = [
+        ("progress", builder.get_trained_progress_model()),
+        ("classifier", builder.get_trained_classifier()),
+    ]
+    print(f"{'model':>10} {'format':>8} {'size':>12} {'load time':>12}")
+    for name, model in models:
+        pickled = pickle.dumps(model)
+        compact = model_format.dumps(model)
+        for format, blob, load in [("pickle", pickled, pickle.loads), ("compact", compact, model_format.loads)]:
+            load_ms = median_load_ms(load, blob, args.repeats)
+            print(f"{name:>10} {format:>8} {len(blob) / 1024:>9.1f} KB {load_ms:>9.2f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+""" Measures the peak memory (RSS) used to fit a ProgressEstimator on a large,
+synthetic problem, with and without densifying the training matrix.
+
+The "dense" mode fits on X.toarray(), which is what ProgressEstimator.fit did
+internally before it worked on sparse input; the "sparse" mode fits on the
+CountVectorizer's output directly. Each mode runs in its own process, so that
+their peak RSS can be compared. Requires the resource module (i.e. not Windows).
+
+Usage (from the repository root):
+    python -m benchmarks.progress_fit_memory --solutions 5000
+"""
+
+import sys, os
+import argparse
+import random
+import resource
+import subprocess
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from shared.preprocess import SimpleAIFBuilder
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, but macOS reports bytes
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024
+
+def generate_solutions(n_solutions, n_lines=20, n_identifiers=150, seed=0):
+    rnd = random.Random(seed)
+    identifiers = [f"value_{i}" for i in range(n_identifiers)]
+    operators = ['+', '-', '*', '//', '%']
+    solutions = []
+    for _ in range(n_solutions):
+        lines = ["def solve(data):", "    result = 0"]
+        for _ in range(n_lines):
+            target, source = rnd.choice(identifiers), rnd.choice(identifiers)
+            lines.append(f"    {target} = {source} {rnd.choice(operators)} {rnd.randint(0, 99)}")
+            if rnd.random() < 0.3:
+                lines.append(f"    if {target} > result:")
+                lines.append(f"        result = {target}")
+        lines.append("    return result")
+        solutions.append("\n".join(lines))
+    return solutions
+
+def run_mode(mode, n_solutions):
+    from shared.progress import ProgressEstimator
+    solutions = generate_solutions(n_solutions)
+    vectorizer = SimpleAIFBuilder(None).create_vectorizer()
+    X = vectorizer.fit_transform(solutions)
+    before_fit = peak_rss_mb()
+    start = time.time()
+    estimator = ProgressEstimator(starter_code="def solve(data):\n    pass", vectorizer=vectorizer)
+    estimator.fit(X.toarray() if mode == "dense" else X)
+    duration = time.time() - start
+    print(f"{mode},{X.shape[0]},{X.shape[1]},{X.nnz},{before_fit:.1f},{peak_rss_mb():.1f},{duration:.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--solutions", type=int, default=5000, help="number of synthetic correct solutions")
+    parser.add_argument("--mode", choices=["dense", "sparse"], help="run a single mode in this process")
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        run_mode(args.mode, args.solutions)
+        return
+
+    print(f"{'mode':>6} {'rows':>7} {'features':>9} {'nonzeros':>10} {'RSS before fit':>15} {'peak RSS':>9} {'fit time':>9}")
+    for mode in ["dense", "sparse"]:
+        result = subprocess.run(
+            [sys.executable, "-m", "benchmarks.progress_fit_memory", "--mode", mode, "--solutions", str(args.solutions)],
+            capture_output=True, text=True,
+            cwd=os.path.join(os.path.dirname(__file__), '..'),
+        )
+        if result.returncode != 0:
+            # Most likely a MemoryError from densifying
+            print(f"{mode:>6} failed: {result.stderr.strip().splitlines()[-1]}")
+            continue
+        output = result.stdout.strip().splitlines()[-1]
+        mode, rows, features, nnz, before, peak, duration = output.split(",")
+        print(f"{mode:>6} {rows:>7} {features:>9} {nnz:>10} {before + ' MB':>15} {peak + ' MB':>9} {duration + ' s':>9}")
+
+if __name__ == '__main__':
+    main()
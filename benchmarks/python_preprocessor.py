@@ -0,0 +1,146 @@
+""" Compares PythonPreprocessor with the implementation it replaced (which
+compiled its regexes on every call, and had no memo or deduplication), and
+checks that both produce identical output for every item of a corpus.
+
+The corpus is the code of a ProgSnap2 dataset's events (with --dataset), or
+else every top-level function and class in the Python standard library.
+
+Three workloads are timed:
+- batch: transforming the whole corpus at once, as when training a model
+- requests: transforming each item on its own, twice, as the classifier and
+  progress model pipelines both do for each FileEdit or Submit request
+- cold calls: remove_comments_and_docstring on each unique item, once
+
+Usage (from the repository root):
+    python -m benchmarks.python_preprocessor [--dataset <dataset>] [--max-items 20000]
+
+Student code can be simulated with a synthetic dataset, e.g.:
+    python -m benchmarks.synthetic_progsnap class.db --students 100 --problems 5
+    python -m benchmarks.python_preprocessor --dataset class.db
+"""
+
+import sys, os
+import argparse
+import ast
+import random
+import re
+import time
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from shared.python_preprocesser import PythonPreprocessor, tests
+
+def reference_remove_via_regex(source):
+    """ PythonPreprocessor's regex stripper, before it was optimized. """
+    pattern = r"(\".*?(?<!\\)\"|\'.*?(?<!\\)\')|(/\*.*?\*/|//[^\r\n]*$)"
+    regex = re.compile(pattern, re.MULTILINE|re.DOTALL)
+    def _replacer(match):
+        if match.group(2) is not None:
+            return ""
+        else:
+            return match.group(1)
+
+    source = regex.sub(_replacer, source)
+    source = re.sub(r'(class|def)(.+)\s+(("""[\s\S]*?""")|(\'\'\'[\s\S]*?\'\'\'))', r'\1\2', source)
+    return source
+
+def reference_remove_comments_and_docstring(source):
+    return reference_remove_via_regex(source).replace("\t", "    ")
+
+def reference_transform(X):
+    return np.array([reference_remove_comments_and_docstring(x) for x in X])
+
+def load_stdlib_corpus():
+    corpus = []
+    directory = os.path.dirname(os.__file__)
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.py'):
+            continue
+        try:
+            with open(os.path.join(directory, name), encoding='utf-8') as file:
+                source = file.read()
+            tree = ast.parse(source)
+        except (SyntaxError, UnicodeDecodeError, ValueError):
+            continue
+        for node in tree.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                segment = ast.get_source_segment(source, node)
+                if segment is not None:
+                    corpus.append(segment)
+    return corpus
+
+def load_dataset_corpus(path):
+    from shared.bulk_build import open_dataset
+    from shared.progsnap import PS2
+    submissions = open_dataset(path).get_submissions()
+    return [code for code in submissions[PS2.Code] if isinstance(code, str)]
+
+def clear_memo():
+    PythonPreprocessor._PythonPreprocessor__memo.clear()
+
+def time_it(function, repeat):
+    """ Returns the fastest of repeat runs, in seconds. """
+    best = float('inf')
+    for _ in range(repeat):
+        clear_memo()
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dataset", help="a ProgSnap2 dataset (a folder of CSV files or a SQLite database) to use as the corpus")
+    parser.add_argument("--max-items", type=int, default=20000, help="the maximum number of items to sample from the corpus")
+    parser.add_argument("--repeat", type=int, default=3, help="each workload's best time of this many runs is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    corpus = load_dataset_corpus(args.dataset) if args.dataset is not None else load_stdlib_corpus()
+    if len(corpus) > args.max_items:
+        corpus = random.Random(args.seed).sample(corpus, args.max_items)
+    print(f"Corpus: {len(corpus)} items ({len(set(corpus))} unique), {sum(len(code) for code in corpus) / 1e6:.1f}M characters")
+
+    # The outputs must be identical, including for the preprocessor's own test cases
+    preprocessor = PythonPreprocessor()
+    for code in corpus + tests:
+        expected = reference_remove_comments_and_docstring(code)
+        clear_memo()
+        if PythonPreprocessor.remove_comments_and_docstring(code) != expected:
+            raise AssertionError(f"Different output for:\n{code}")
+        if preprocessor.transform([code])[0] != expected:
+            raise AssertionError(f"Different transformed output for:\n{code}")
+    if not np.array_equal(preprocessor.transform(corpus), reference_transform(corpus)):
+        raise AssertionError("Different output when transforming the whole corpus")
+    print("Outputs are identical")
+
+    def reference_requests():
+        for code in corpus:
+            reference_transform([code])
+            reference_transform([code])
+
+    def requests():
+        for code in corpus:
+            preprocessor.transform([code])
+            preprocessor.transform([code])
+
+    unique = list(dict.fromkeys(corpus))
+
+    def cold_calls():
+        # Each item is only seen once, so nothing is memoized
+        for code in unique:
+            PythonPreprocessor.remove_comments_and_docstring(code)
+
+    workloads = [
+        ("batch", lambda: reference_transform(corpus), lambda: preprocessor.transform(corpus)),
+        ("requests", reference_requests, requests),
+        ("cold calls", lambda: [reference_remove_comments_and_docstring(code) for code in unique], cold_calls),
+    ]
+    print(f"\n{'workload':>12} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for name, before, after in workloads:
+        before_seconds = time_it(before, args.repeat)
+        after_seconds = time_it(after, args.repeat)
+        print(f"{name:>12} {before_seconds * 1000:>10.1f} {after_seconds * 1000:>10.1f} {before_seconds / after_seconds:>7.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+""" Generates a synthetic ProgSnap2 dataset, where each of N students works
+through M problems. Students type each problem's solution a few characters at
+a time (FileEdit events every few seconds), sometimes make and fix typos, run
+their code (Run.Program) every few lines, and submit (Submit) when they are
+done, resubmitting until their code is correct.
+
+Each problem has its own solution, and each student uses their own variable
+names and constants, so there are many distinct correct solutions.
+
+Usage (from the repository root), to write a SQLite ProgSnap2 database:
+    python -m benchmarks.synthetic_progsnap data.db --students 200 --problems 10
+"""
+
+import sys, os
+import argparse
+import datetime
+import random
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from shared.data import SQLiteLogger
+
+START_TIME = datetime.datetime(2024, 1, 8, 9, 0, 0)
+STARTER_CODE = "def solve(data):\n    pass"
+
+def generate_solution(rnd, n_lines):
+    """ Returns a solution template, where {0}, {1}, ... are variable names and
+    {c0}, {c1}, ... are constants, which vary between students.
+    """
+    lines = ["def solve(data):", "    {0} = 0"]
+    n_variables, n_constants = 1, 0
+    while len(lines) < n_lines - 1:
+        kind = rnd.random()
+        if kind < 0.3 and len(lines) < n_lines - 3:
+            lines.append(f"    for {{{n_variables}}} in data:")
+            lines.append(f"        if {{{n_variables}}} > {{c{n_constants}}}:")
+            lines.append(f"            {{0}} += {{{n_variables}}}")
+            n_variables += 1
+            n_constants += 1
+        elif kind < 0.6:
+            lines.append(f"    {{{n_variables}}} = len(data) * {{c{n_constants}}}")
+            lines.append(f"    {{0}} = max({{0}}, {{{n_variables}}})")
+            n_variables += 1
+            n_constants += 1
+        else:
+            lines.append(f"    {{0}} = {{0}} % {{c{n_constants}}} + {rnd.choice(['1', 'len(data)', 'sum(data)'])}")
+            n_constants += 1
+    lines.append("    return {0}")
+    return "\n".join(lines), n_variables, n_constants
+
+def personalize(rnd, template, n_variables, n_constants):
+    names = rnd.sample(["total", "result", "count", "value", "x", "item", "acc", "best", "n", "tmp", "score", "i", "k"], n_variables)
+    constants = {f"c{i}": rnd.randint(1, 20) for i in range(n_constants)}
+    return template.format(*names, **constants)
+
+def generate_events(n_students, n_problems, seed=0, start_spread=3600):
+    """ Returns a list of events, sorted by time, where each event is a dict with
+    the EventType, request fields (SubjectID, ProblemID, CodeState, Score and
+    ClientTimestamp), and the Time (in seconds) since the first event.
+    """
+    rnd = random.Random(seed)
+    solutions = [generate_solution(rnd, rnd.randint(8, 20)) for _ in range(n_problems)]
+    events = []
+    for student in range(n_students):
+        subject_id = f"student{student}"
+        # Students start at different times, and work through problems in order
+        time = rnd.uniform(0, start_spread)
+        for problem in range(n_problems):
+            problem_id = f"problem{problem}"
+            solution = personalize(rnd, *solutions[problem])
+
+            def add(event_type, code, score=None):
+                event = {
+                    "EventType": event_type,
+                    "SubjectID": subject_id,
+                    "ProblemID": problem_id,
+                    "CodeState": code,
+                    "ClientTimestamp": (START_TIME + datetime.timedelta(seconds=time)).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+                    "Time": time,
+                }
+                if score is not None:
+                    event["Score"] = score
+                events.append(event)
+
+            typed = 0
+            lines_at_last_run = 0
+            while typed < len(solution):
+                time += rnd.expovariate(1 / 8)
+                typed = min(len(solution), typed + rnd.randint(3, 25))
+                code = solution[:typed]
+                if rnd.random() < 0.1:
+                    # A typo, which is fixed by the next edit
+                    code += rnd.choice(["x", ")", ":", "  "])
+                add("FileEdit", code)
+                lines = code.count("\n")
+                if lines - lines_at_last_run >= 4 and rnd.random() < 0.5:
+                    time += rnd.uniform(1, 5)
+                    add("Run.Program", code)
+                    lines_at_last_run = lines
+            # Some first submissions have a bug, which is then fixed
+            while rnd.random() < 0.4:
+                time += rnd.uniform(2, 30)
+                buggy = solution.replace(" > ", " >= ", 1) if " > " in solution else solution.replace("return", "print(", 1)
+                add("Submit", buggy, round(rnd.uniform(0, 0.8), 2))
+                time += rnd.expovariate(1 / 20)
+                add("FileEdit", solution)
+            time += rnd.uniform(2, 30)
+            add("Submit", solution, 1)
+            # A break between problems
+            time += rnd.expovariate(1 / 120)
+    events.sort(key=lambda event: event["Time"])
+    return events
+
+def get_problem_ids(n_problems):
+    return [f"problem{problem}" for problem in range(n_problems)]
+
+def write_database(events, n_problems, path, batch_size=1000):
+    """ Logs the events to a SQLite ProgSnap2 database (as the server does). """
+    logger = SQLiteLogger(path)
+    for problem_id in get_problem_ids(n_problems):
+        logger.set_starter_code(problem_id, STARTER_CODE)
+    rows = []
+    for event in events:
+        row = {key: value for key, value in event.items() if key not in ("EventType", "Time")}
+        rows.append((event["EventType"], row))
+    for start in range(0, len(rows), batch_size):
+        logger.log_events(rows[start:start + batch_size])
+    logger.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("database", help="path of the .db file to write")
+    parser.add_argument("--students", type=int, default=200)
+    parser.add_argument("--problems", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if os.path.exists(args.database):
+        parser.error(f"{args.database} already exists")
+    events = generate_events(args.students, args.problems, args.seed)
+    write_database(events, args.problems, args.database)
+    counts = {}
+    for event in events:
+        counts[event["EventType"]] = counts.get(event["EventType"], 0) + 1
+    print(f"Wrote {len(events)} events to {args.database}: {counts}")
+
+if __name__ == '__main__':
+    main()
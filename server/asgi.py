@@ -0,0 +1,234 @@
+""" An ASGI version of the feedback routes in main.py, for serving many
+concurrent connections from one process, e.g. with:
+    uvicorn server.asgi:app --host 0.0.0.0 --port 80
+
+Requests are handled by asyncio, and the blocking work is done on two bounded
+thread pools: one for database work (logging, condition assignment and loading
+models), and one for running the models. Models are cached per process, so
+inference threads share them.
+"""
+
+import sys, os
+import json
+import time
+import asyncio
+import contextvars
+import functools
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+# Needed, since this is run in a subfolder
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from server.main import fb_gen, config, LOG_DATABASE, FORMAT_HTML, METRICS_ENABLED, REQUEST_SECONDS
+from server.main import profiler, should_profile_request, get_stats
+from shared import metrics
+
+ASGI_CONFIG = config.get("asgi", {})
+ASGI_DB_THREADS = ASGI_CONFIG.get("db_threads", 8)
+ASGI_INFERENCE_THREADS = ASGI_CONFIG.get("inference_threads", os.cpu_count())
+
+db_executor = ThreadPoolExecutor(max_workers=ASGI_DB_THREADS, thread_name_prefix="aif-db")
+inference_executor = ThreadPoolExecutor(max_workers=ASGI_INFERENCE_THREADS, thread_name_prefix="aif-inference")
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+# The profiler key of the current request, if it is being profiled
+profile_key = contextvars.ContextVar("profile_key", default=None)
+
+def run_profiled(key, function, *args):
+    with profiler.profile(*key):
+        return function(*args)
+
+async def run_in(executor, function, *args):
+    # Work is done on the executors' threads, so that's where it's profiled
+    key = profile_key.get()
+    if key is not None:
+        function = functools.partial(run_profiled, key, function)
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+async def run_db(function, *args):
+    return await run_in(db_executor, function, *args)
+
+async def run_inference(function, *args):
+    return await run_in(inference_executor, function, *args)
+
+def load_feedback_models(body):
+    """ Returns the models to generate feedback for the request with (see
+    FeedbackGenerator.load_versioned_models_from_db), or None if the subject
+    shouldn't get feedback.
+    """
+    problem_id = body["ProblemID"]
+    if "SubjectID" in body:
+        if not fb_gen.is_intervention_group(body["SubjectID"], problem_id):
+            return None
+    else:
+        print("Warning: No SubjectID provided")
+    return fb_gen.load_versioned_models_from_db(problem_id)
+
+async def log_and_generate_feedback(event_type, body):
+    if "CodeState" not in body or "ProblemID" not in body:
+        raise HTTPError(400, "Requests must include a ProblemID and CodeState")
+    # Logging is independent of the feedback, so they are done at the same time
+    log = run_db(fb_gen.log, event_type, body)
+    load = run_db(load_feedback_models, body)
+    _, models = await asyncio.gather(log, load)
+    if models is None:
+        return []
+    database, version, models = models
+    return await run_inference(
+        fb_gen.generate_feedback_from_models, database, version, models,
+        body["ProblemID"], body["CodeState"], body.get("format", FORMAT_HTML)
+    )
+
+async def submit(body):
+    return await log_and_generate_feedback("Submit", body)
+
+async def file_edit(body):
+    return await log_and_generate_feedback("FileEdit", body)
+
+async def run_program(body):
+    await run_db(fb_gen.log, "Run.Program", body)
+    return []
+
+async def set_starter_code(body):
+    problem_id = body.get("ProblemID")
+    starter_code = body.get("StarterCode")
+    if starter_code is None or problem_id is None:
+        return []
+    await run_db(fb_gen.get_logger(LOG_DATABASE).set_starter_code, problem_id, starter_code)
+    return []
+
+async def hello_world(body):
+    return 'Hello, World!'
+
+async def stats(body):
+    stats = get_stats()
+    stats["executors"] = {
+        "db_threads": ASGI_DB_THREADS,
+        "inference_threads": ASGI_INFERENCE_THREADS,
+    }
+    return stats
+
+class PlainText(str):
+    pass
+
+async def get_metrics(body):
+    if not METRICS_ENABLED:
+        raise HTTPError(404, "Metrics are disabled; set metrics.enabled in the config")
+    return PlainText(metrics.render())
+
+# Each route's method and handler, which is passed the parsed JSON body
+ROUTES = {
+    '/': ('GET', hello_world),
+    '/X-Stats/': ('GET', stats),
+    '/Submit/': ('POST', submit),
+    '/FileEdit/': ('POST', file_edit),
+    '/Run.Program/': ('POST', run_program),
+    '/X-SetStarterCode/': ('POST', set_starter_code),
+    '/metrics/': ('GET', get_metrics),
+}
+
+# Matches the CORS(app) defaults used by main.py
+CORS_HEADERS = [(b'access-control-allow-origin', b'*')]
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+async def send_response(send, status, body, content_type=b'application/json', headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())] + CORS_HEADERS + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def send_json(send, status, value):
+    if isinstance(value, PlainText):
+        await send_response(send, status, value.encode('utf-8'), b'text/plain; version=0.0.4; charset=utf-8')
+        return
+    if isinstance(value, str):
+        await send_response(send, status, value.encode('utf-8'), b'text/html; charset=utf-8')
+        return
+    await send_response(send, status, json.dumps(value).encode('utf-8'))
+
+async def handle_http(scope, receive, send):
+    path = scope['path']
+    if not path.endswith('/'):
+        path += '/'
+    if path not in ROUTES:
+        await send_json(send, 404, {"error": "Not found"})
+        return
+    method, handler = ROUTES[path]
+    request_headers = dict(scope['headers'])
+    if scope['method'] == 'OPTIONS':
+        # A CORS preflight request
+        allowed_headers = request_headers.get(b'access-control-request-headers', b'')
+        await send_response(send, 200, b'', b'text/plain', [
+            (b'access-control-allow-methods', method.encode() + b', OPTIONS'),
+            (b'access-control-allow-headers', allowed_headers),
+        ])
+        return
+    if scope['method'] != method:
+        await send_json(send, 405, {"error": "Method not allowed"})
+        return
+    body = await read_body(receive)
+    if body is None:
+        # The client disconnected, so there's no one to respond to
+        return
+    start = time.perf_counter()
+    await handle_request(send, path, handler, method, body)
+    REQUEST_SECONDS.observe(time.perf_counter() - start, route=path)
+
+async def handle_request(send, path, handler, method, body):
+    try:
+        parsed = None
+        if method == 'POST':
+            try:
+                parsed = json.loads(body)
+            except ValueError:
+                raise HTTPError(400, "The body must be JSON")
+            if not isinstance(parsed, dict):
+                raise HTTPError(400, "The body must be a JSON object")
+        key = None
+        if should_profile_request():
+            problem_id = parsed.get("ProblemID") if parsed is not None else None
+            key = (path, problem_id or "none")
+        profile_key.set(key)
+        result = await handler(parsed)
+    except HTTPError as e:
+        await send_json(send, e.status, {"error": e.message})
+        return
+    except Exception:
+        traceback.print_exc()
+        await send_json(send, 500, {"error": "Internal server error"})
+        return
+    await send_json(send, 200, result)
+
+async def handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            db_executor.shutdown(wait=True)
+            inference_executor.shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http':
+        await handle_http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await handle_lifespan(receive, send)
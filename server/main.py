@@ -1,16 +1,24 @@
-import sys, os, datetime, traceback, random
+import sys, os, datetime, traceback, random, copy, threading, collections
+import json
 import yaml
 import time
 # Needed, since this is run in a subfolder
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from flask import Flask, request, render_template_string, g
+from flask import Flask, Response, request, g
 from flask_restful import Resource
 from flask_cors import CORS
-from shared.data import SQLiteLogger
+from shared.data import SQLiteLogger, code_hash
+from shared.cache import LRUCache, ModelCache
+from shared.model_store import SharedModelStore
+from shared import metrics
+from shared.metrics import STAGE_SECONDS
+from shared.profiler import StackProfiler
+from shared.scheduler import BuildScheduler
 from shared.database import SQLiteDataProvider, MultiDataProvider
 from shared.progsnap import ProgSnap2Dataset
-from shared.preprocess import SimpleAIFBuilder
+from shared.preprocess import SimpleAIFBuilder, SUBMIT_EVENT_TYPES
+from shared.python_preprocesser import PythonPreprocessor
 from sklearn.dummy import DummyClassifier
 
 app = Flask(__name__)
@@ -20,7 +28,10 @@ def relative_path(path):
     basedir = os.path.abspath(os.path.dirname(__file__))
     return os.path.join(basedir, path)
 
-config_path = relative_path("config.yaml")
+# The config file can also be given by the SIMPLEAIF_CONFIG environment variable
+config_path = os.environ.get("SIMPLEAIF_CONFIG", relative_path("config.yaml"))
+if "SIMPLEAIF_CONFIG" in os.environ and not os.path.exists(config_path):
+    raise FileNotFoundError(f"No config file at {config_path}")
 if not os.path.exists(config_path):
     config_path = relative_path("config.default.yaml")
     print("Warning: Loading default config file! Createa a server/config.yaml file.")
@@ -29,6 +40,11 @@ config = yaml.safe_load(open(config_path))
 print(config)
 
 LOG_DATABASE = config["log_database"]
+# Where databases, journals, snapshots, etc. are stored, relative to this folder
+DATA_DIRECTORY = relative_path(config.get("data_directory", "data"))
+
+def data_path(path):
+    return os.path.join(DATA_DIRECTORY, path)
 
 SHOW_SUBGOALS = config["show_subgoals"]
 SHOW_STATUS = config["show_status"]
@@ -40,21 +56,89 @@ BUILD_REBUILD_MODELS = config["build"]["rebuild_models"]
 BUILD_MIN_CORRECT_COUNT_FOR_FEEDBACK = config["build"]["min_correct_count_for_feedback"]
 BUILD_INCREMENT = config["build"]["increment"]
 BUILD_LANG = config["build"]["language"]
+BUILD_MODEL_CACHE_MB = config["build"].get("model_cache_mb", 512)
+BUILD_SHARED_MODEL_STORE = config["build"].get("shared_model_store", False)
+BUILD_IN_BACKGROUND = config["build"].get("build_in_background", True)
+BUILD_MAX_CONCURRENT_BUILDS = config["build"].get("max_concurrent_builds", 1)
+BUILD_TRAINING_SNAPSHOTS = config["build"].get("training_snapshots", True)
+BUILD_PARTIAL_FIT = config["build"].get("partial_fit", False)
 # TODO: Add token pattern
 
+JOURNAL_CONFIG = config.get("journal", {})
+JOURNAL_ENABLED = JOURNAL_CONFIG.get("enabled", False)
+JOURNAL_FLUSH_INTERVAL = JOURNAL_CONFIG.get("flush_interval", 1)
+JOURNAL_FLUSH_SIZE = JOURNAL_CONFIG.get("flush_size", 500)
+
+METRICS_ENABLED = config.get("metrics", {}).get("enabled", False)
+
+PROFILING_CONFIG = config.get("profiling", {})
+PROFILING_ENABLED = PROFILING_CONFIG.get("enabled", False)
+PROFILING_SAMPLE_RATE = PROFILING_CONFIG.get("sample_rate", 0.01)
+PROFILING_INTERVAL_MS = PROFILING_CONFIG.get("interval_ms", 5)
+PROFILING_FLUSH_INTERVAL = PROFILING_CONFIG.get("flush_interval", 60)
+PROFILING_MAX_FILES = PROFILING_CONFIG.get("max_files", 500)
+
+FEEDBACK_CACHE_CONFIG = config.get("feedback_cache", {})
+FEEDBACK_CACHE_MAX_ENTRIES = FEEDBACK_CACHE_CONFIG.get("max_entries", 10000)
+FEEDBACK_CACHE_TTL = FEEDBACK_CACHE_CONFIG.get("ttl", 600)
+
+# Feedback is returned as rendered HTML by default, or as just the scores
+# if the request has "format": "json"
+FORMAT_HTML = "html"
+FORMAT_JSON = "json"
+
+# The progress at which the status is shown as complete
+PROGRESS_CUTOFF = 0.9
+# The number of items scored at once for each problem by /BatchFeedback/
+BATCH_CHUNK_SIZE = 1000
+
 CONDITIONS_ASSIGNMENT = config["conditions"]["assignment"]
 CONDITIONS_INTERVENTION_PROBABILITY = config["conditions"]["intervention_probability"]
 CONDITIONS_INVERSE_PROBLEMS = config["conditions"]["inverse_problems"]
 CONDITIONS_MANUALLY_ASSIGNED_PROBLEMS = config["conditions"]["manually_assigned_problems"]
 
+REQUEST_SECONDS = metrics.Histogram(
+    'simpleaif_request_seconds', 'Time taken to handle each request', ['route'])
+REBUILDS = metrics.Counter(
+    'simpleaif_rebuilds_total', 'Model rebuilds, by whether they succeeded', ['result'])
+REBUILD_SECONDS = metrics.Histogram(
+    'simpleaif_rebuild_seconds', 'Time taken by successful model rebuilds',
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+if METRICS_ENABLED:
+    metrics.enable()
+
+profiler = None
+if PROFILING_ENABLED:
+    profiler = StackProfiler(
+        data_path('profiles'), PROFILING_INTERVAL_MS / 1000,
+        PROFILING_FLUSH_INTERVAL, PROFILING_MAX_FILES
+    )
+
+def should_profile_request():
+    return profiler is not None and random.random() < PROFILING_SAMPLE_RATE
+
 class FeedbackGenerator(Resource):
 
     def get_logger(self, system_id):
         if system_id in self.loggers:
             return self.loggers[system_id]
-        logger = SQLiteLogger(relative_path(f'data/{system_id}.db'))
+        with self.loggers_lock:
+            if system_id not in self.loggers:
+                self.loggers[system_id] = self.__create_logger(system_id)
+            return self.loggers[system_id]
+
+    def __create_logger(self, system_id):
+        model_store = None
+        if BUILD_SHARED_MODEL_STORE:
+            model_store = SharedModelStore(data_path(f'models/{system_id}'))
+        logger = SQLiteLogger(data_path(f'{system_id}.db'), self.model_cache, model_store)
         logger.create_tables()
-        self.loggers[system_id] = logger
+        if system_id == LOG_DATABASE and JOURNAL_ENABLED:
+            logger.enable_journal(
+                data_path(f'journal/{system_id}'),
+                flush_interval=JOURNAL_FLUSH_INTERVAL,
+                flush_size=JOURNAL_FLUSH_SIZE,
+            )
         return logger
 
     def load_models_from_logger(self, problem_id, database):
@@ -63,33 +147,70 @@ class FeedbackGenerator(Resource):
         return models
 
 
-    def load_models_from_db(self, problem_id):
+    def get_model_databases(self):
         # If we don't have a model database, just use the log database
         if BUILD_MODEL_DATABASE is None:
-            database = LOG_DATABASE
+            return [LOG_DATABASE]
         # If we aren't rebuilding models, just use the model database
-        elif not BUILD_REBUILD_MODELS:
-            database = BUILD_MODEL_DATABASE
-        # If we have a model database, but we're also rebuilding models...
-        else:
-            # First check if we've build this model from log data
-            database = LOG_DATABASE
-            models = self.load_models_from_logger(problem_id, database)
-            # If we haven't, check the model database
-            if models is None:
-                database = BUILD_MODEL_DATABASE
-        models = self.load_models_from_logger(problem_id, database)
-        if models is None:
-            print(f"Model not found for {problem_id} in {database}.db")
-        return models
+        if not BUILD_REBUILD_MODELS:
+            return [BUILD_MODEL_DATABASE]
+        # If we have a model database, but we're also rebuilding models,
+        # first check if we've build this model from log data, and if we
+        # haven't, check the model database
+        return [LOG_DATABASE, BUILD_MODEL_DATABASE]
+
+    def load_models_from_db(self, problem_id):
+        return self.load_versioned_models_from_db(problem_id)[2]
+
+    def load_versioned_models_from_db(self, problem_id):
+        """ Returns the database the models were found in, their version and the models,
+        or (None, None, None) if no models were found.
+        """
+        databases = self.get_model_databases()
+        for database in databases:
+            with STAGE_SECONDS.time(stage="load_models"):
+                version, models = self.get_logger(database).get_versioned_models(problem_id)
+            if models is not None:
+                return database, version, models
+        print(f"Model not found for {problem_id} in {databases[-1]}.db")
+        return None, None, None
 
     def __init__(self) -> None:
         super().__init__()
         self.loggers = {}
+        # Loggers may be requested from several threads (e.g. builds)
+        self.loggers_lock = threading.Lock()
+        self.model_cache = ModelCache(BUILD_MODEL_CACHE_MB * 1024 * 1024)
+        # Students often send the same code repeatedly (e.g. re-submitting, or
+        # undo/redo), and the feedback only changes when the model is rebuilt
+        self.feedback_cache = LRUCache(FEEDBACK_CACHE_MAX_ENTRIES, ttl=FEEDBACK_CACHE_TTL)
+        self.build_scheduler = None
+        if BUILD_REBUILD_MODELS and BUILD_IN_BACKGROUND:
+            self.build_scheduler = BuildScheduler(self.rebuild_model, BUILD_MAX_CONCURRENT_BUILDS)
+        # Correct submissions waiting to be added to each problem's progress model
+        self.pending_updates = {}
+        self.pending_updates_lock = threading.Lock()
+        self.update_scheduler = None
+        if BUILD_REBUILD_MODELS and BUILD_PARTIAL_FIT and BUILD_IN_BACKGROUND:
+            self.update_scheduler = BuildScheduler(self.update_progress_model)
         path = relative_path("templates/progress.html")
         file=open(path,"r")
-        self.progress_tempalte = '\n'.join(file.readlines())
+        # Compiled once, rather than on every call to render_template_string
+        self.progress_template = app.jinja_env.from_string('\n'.join(file.readlines()))
         file.close()
+        self.render_count = 0
+        self.render_seconds = 0
+        self.render_lock = threading.Lock()
+        # The (ProblemID, unique correct submissions, seconds) of recent rebuilds
+        self.recent_builds = collections.deque(maxlen=100)
+
+    def get_render_stats(self):
+        with self.render_lock:
+            count, seconds = self.render_count, self.render_seconds
+        return {
+            "count": count,
+            "mean_ms": 1000 * seconds / count if count > 0 else 0,
+        }
 
     def log(self, event_type, dict):
         logger = self.get_logger(LOG_DATABASE)
@@ -101,42 +222,129 @@ class FeedbackGenerator(Resource):
             dict["ClientTimestamp"] = datetime.datetime.strptime(client_timestamp, "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%Y-%m-%dT%H:%M:%S")
         except:
             pass
-        logger.log_event(event_type, dict)
+        with STAGE_SECONDS.time(stage="log_event"):
+            logger.log_event(event_type, dict)
         if "ProblemID" in dict:
+            self.update_if_needed(event_type, dict)
             self.rebuild_if_needed(dict["ProblemID"])
 
+    def update_if_needed(self, event_type, dict):
+        if not BUILD_REBUILD_MODELS or not BUILD_PARTIAL_FIT:
+            return
+        if event_type not in SUBMIT_EVENT_TYPES or not isinstance(dict.get("CodeState"), str):
+            return
+        try:
+            if float(dict.get("Score")) < 1:
+                return
+        except (TypeError, ValueError):
+            return
+        problem_id = str(dict["ProblemID"])
+        with self.pending_updates_lock:
+            self.pending_updates.setdefault(problem_id, []).append(dict["CodeState"])
+        if self.update_scheduler is not None:
+            self.update_scheduler.request_build(problem_id)
+            return
+        try:
+            self.update_progress_model(problem_id)
+        except Exception as e:
+            print(f"Failed AIF update for {problem_id}")
+            traceback.print_exc()
+
+    def update_progress_model(self, problem_id):
+        """ Adds pending correct submissions to the problem's progress model using
+        partial_fit, so the model improves between full rebuilds.
+        """
+        with self.pending_updates_lock:
+            codes = self.pending_updates.pop(problem_id, [])
+        if len(codes) == 0:
+            return
+        # Only models built from the log database are updated
+        logger = self.get_logger(LOG_DATABASE)
+        version, models = logger.get_versioned_models(problem_id)
+        if models is None:
+            return
+        progress_model, classifier = models
+        if not hasattr(progress_model, "partial_fit") or getattr(progress_model.steps[-1][1], "is_compact", False):
+            return
+        # The cached model may be in use by other requests, so we update a copy
+        progress_model = copy.deepcopy(progress_model)
+        progress_model.partial_fit(codes)
+        if not logger.update_progress_model(problem_id, progress_model, version):
+            # The next rebuild will include these submissions
+            print(f"Skipped AIF update for {problem_id}, since it was rebuilt")
+            return
+        print(f"Updated AIF for {problem_id} with {len(codes)} correct submissions")
+
     def rebuild_if_needed(self, problem_id):
         if not BUILD_REBUILD_MODELS:
             return
         problem_id = str(problem_id)
         logger = self.get_logger(LOG_DATABASE)
-        if not logger.should_rebuild_model(problem_id, BUILD_MIN_CORRECT_COUNT_FOR_FEEDBACK, BUILD_INCREMENT):
+        with STAGE_SECONDS.time(stage="should_rebuild_model"):
+            should_rebuild = logger.should_rebuild_model(problem_id, BUILD_MIN_CORRECT_COUNT_FOR_FEEDBACK, BUILD_INCREMENT)
+        if not should_rebuild:
+            return
+        # Builds can take minutes, so by default we only enqueue them here
+        if self.build_scheduler is not None:
+            self.build_scheduler.request_build(problem_id)
             return
         try:
-            logging_provider = SQLiteDataProvider(logger.db_path)
-            if BUILD_MODEL_DATABASE is None:
-                provider = logging_provider
-            else:
-                model_provider = SQLiteDataProvider(self.get_logger(BUILD_MODEL_DATABASE).db_path)
-                provider = MultiDataProvider([logging_provider, model_provider])
-            dataset = ProgSnap2Dataset(provider)
-            builder = SimpleAIFBuilder(problem_id)
-            builder.lang = BUILD_LANG
-            # TODO: Add token pattern
-            builder.build(dataset)
-            progress_model = builder.get_trained_progress_model()
-            if SHOW_STATUS:
-                classifier = builder.get_trained_classifier()
-            else:
-                # If we aren't using the classifier, just leave it blank
-                classifier = None
-            correct_count = int(builder.X_train[builder.y_train].unique().size)
-            logger.set_models(problem_id, progress_model, classifier, correct_count)
-            print(f"Successfully rebuilt AIF for {problem_id} with {correct_count} unique correct submissions")
+            self.rebuild_model(problem_id)
         except Exception as e:
             print(f"Failed AIF build for {problem_id}")
             traceback.print_exc()
+
+    def rebuild_model(self, problem_id):
+        logger = self.get_logger(LOG_DATABASE)
+        # A queued build may have been made redundant by one that finished before it started
+        if not logger.should_rebuild_model(problem_id, BUILD_MIN_CORRECT_COUNT_FOR_FEEDBACK, BUILD_INCREMENT):
             return
+        try:
+            if profiler is not None:
+                # Every rebuild is profiled
+                with profiler.profile("rebuild", problem_id):
+                    duration = self.__rebuild_model(problem_id, logger)
+            else:
+                duration = self.__rebuild_model(problem_id, logger)
+        except:
+            REBUILDS.inc(result="failure")
+            raise
+        REBUILDS.inc(result="success")
+        REBUILD_SECONDS.observe(duration)
+
+    def __rebuild_model(self, problem_id, logger):
+        start = time.time()
+        logging_provider = SQLiteDataProvider(logger.db_path)
+        if BUILD_MODEL_DATABASE is None:
+            provider = logging_provider
+        else:
+            model_provider = SQLiteDataProvider(self.get_logger(BUILD_MODEL_DATABASE).db_path)
+            provider = MultiDataProvider([logging_provider, model_provider])
+        dataset = ProgSnap2Dataset(provider)
+        builder = SimpleAIFBuilder(problem_id)
+        builder.lang = BUILD_LANG
+        if BUILD_TRAINING_SNAPSHOTS:
+            # Snapshots depend on which databases the submissions are read from
+            snapshot_name = LOG_DATABASE if BUILD_MODEL_DATABASE is None else f'{LOG_DATABASE}-{BUILD_MODEL_DATABASE}'
+            builder.snapshot_directory = data_path(f'snapshots/{snapshot_name}')
+        # TODO: Add token pattern
+        builder.build(dataset)
+        progress_model = builder.get_trained_progress_model()
+        if not BUILD_PARTIAL_FIT:
+            # Compacted models are smaller and faster, but can't be updated
+            progress_model.compact()
+        if SHOW_STATUS:
+            classifier = builder.get_trained_classifier()
+        else:
+            # If we aren't using the classifier, just leave it blank
+            classifier = None
+        correct_count = int(builder.X_train[builder.y_train].unique().size)
+        # Storing the models also invalidates any cached copies, installing the new ones
+        logger.set_models(problem_id, progress_model, classifier, correct_count)
+        duration = time.time() - start
+        self.recent_builds.append((problem_id, correct_count, duration))
+        print(f"Successfully rebuilt AIF for {problem_id} with {correct_count} unique correct submissions in {duration:.2f}s")
+        return duration
 
     def default_condition_is_intervention(self, id):
         state = str(LOG_DATABASE) + str(id)
@@ -156,8 +364,9 @@ class FeedbackGenerator(Resource):
         if CONDITIONS_ASSIGNMENT == "all_intervention":
             return True
         logger = self.get_logger(LOG_DATABASE)
-        subject_condition = logger.get_or_set_subject_condition(
-            subject_id, self.default_condition_is_intervention(subject_id))
+        with STAGE_SECONDS.time(stage="condition"):
+            subject_condition = logger.get_or_set_subject_condition(
+                subject_id, self.default_condition_is_intervention(subject_id))
         if problem_id in CONDITIONS_INVERSE_PROBLEMS:
             # print(f"Problem {problem_id} is inverse; switching {subject_condition} to {not subject_condition}")
             subject_condition = not subject_condition
@@ -168,31 +377,155 @@ class FeedbackGenerator(Resource):
             print(f"Unknown condition assignment: {CONDITIONS_ASSIGNMENT}")
             return True
 
-    def generate_feedback(self, problemID, code):
-        models = self.load_models_from_db(problemID)
+    def get_status(self, progress, score):
+        if progress <= PROGRESS_CUTOFF:
+            return "In Progress"
+        if score > 0.75:
+            return "Great!"
+        if score > 0.5:
+            return "Good"
+        return "Maybe Bugs"
+
+    def generate_batch_feedback(self, items, chunk_size=BATCH_CHUNK_SIZE):
+        """ Scores a list of {ProblemID, CodeState, SubjectID} items, yielding
+        a result for each item as soon as its problem (or chunk of a problem)
+        has been scored. Results include the item's index, since they are
+        grouped by problem rather than returned in order. Nothing is logged.
+        """
+        indices_by_problem = {}
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or "ProblemID" not in item or "CodeState" not in item:
+                yield self.__batch_result(index, item if isinstance(item, dict) else {},
+                                          error="Items must include a ProblemID and CodeState")
+                continue
+            problem_id = item["ProblemID"]
+            # Numeric ProblemIDs are accepted, as they are by the other routes
+            if problem_id is None or not isinstance(problem_id, (str, int, float)) or not isinstance(item["CodeState"], str):
+                yield self.__batch_result(index, item, error="The ProblemID must be a string or number, and the CodeState a string")
+                continue
+            indices_by_problem.setdefault(str(problem_id), []).append(index)
+
+        for problem_id, indices in indices_by_problem.items():
+            try:
+                models = self.load_models_from_db(problem_id)
+            except Exception:
+                print(f"Failed to load models for {problem_id}")
+                traceback.print_exc()
+                for index in indices:
+                    yield self.__batch_result(index, items[index], error="Failed to load the model for this problem")
+                continue
+            for start in range(0, len(indices), chunk_size):
+                chunk = indices[start:start + chunk_size]
+                if models is None:
+                    for index in chunk:
+                        yield self.__batch_result(index, items[index], error="No model found for this problem")
+                    continue
+                try:
+                    results = self.__score_batch_chunk(models, items, chunk)
+                except Exception:
+                    print(f"Failed to score a batch for {problem_id}")
+                    traceback.print_exc()
+                    results = [self.__batch_result(index, items[index], error="Failed to score this item") for index in chunk]
+                yield from results
+
+    def __score_batch_chunk(self, models, items, indices):
+        """ Returns the results of scoring the given items, all at once, so a
+        failure doesn't leave some items without results.
+        """
+        progress_model, classifier = models
+        codes = [items[index]["CodeState"] for index in indices]
+        subgoal_list = [] if SHOW_SUBGOALS else None
+        # Each model is run once for the whole chunk
+        if SHOW_STATUS and classifier is not None:
+            scores = classifier.predict_proba(codes)[:,1]
+        else:
+            scores = [0] * len(codes)
+        progresses = progress_model.predict_proba(codes, subgoal_list=subgoal_list)
+        results = []
+        for i, index in enumerate(indices):
+            progress, score = float(progresses[i]), float(scores[i])
+            result = self.__batch_result(index, items[index])
+            result["progress"] = progress
+            result["score"] = score
+            result["status"] = self.get_status(progress, score)
+            if subgoal_list is not None:
+                result["subgoals"] = [
+                    {"name": subgoal["name"], "score": float(subgoal["score"][i])}
+                    for subgoal in subgoal_list
+                ]
+            results.append(result)
+        return results
+
+    def __batch_result(self, index, item, error=None):
+        result = {
+            "index": index,
+            "ProblemID": item.get("ProblemID"),
+            "SubjectID": item.get("SubjectID"),
+        }
+        if error is not None:
+            result["error"] = error
+        return result
+
+    def generate_feedback(self, problemID, code, format=FORMAT_HTML):
+        database, version, models = self.load_versioned_models_from_db(problemID)
+        return self.generate_feedback_from_models(database, version, models, problemID, code, format)
+
+    def generate_feedback_from_models(self, database, version, models, problemID, code, format=FORMAT_HTML):
+        """ Generates feedback using the result of load_versioned_models_from_db,
+        which lets callers (e.g. server/asgi.py) load models separately.
+        """
         if models is None:
             return []
+        cache_key = None
+        if isinstance(code, str):
+            # The model version changes on rebuild, so old feedback is never reused
+            cache_key = (database, str(problemID), version, code_hash(code), format)
+            feedback = self.feedback_cache.get(cache_key)
+            if feedback is not None:
+                return feedback
+        feedback = self.__generate_feedback(models, code, format)
+        if cache_key is not None:
+            self.feedback_cache.put(cache_key, feedback)
+        return feedback
+
+    def __generate_feedback(self, models, code, format):
         progress_model, classifier = models
 
         subgoal_list = None
         if SHOW_SUBGOALS:
             subgoal_list = []
 
-        score = classifier.predict_proba([code])[0,1] if SHOW_STATUS and classifier is not None else 0
-        progress = progress_model.predict_proba([code], subgoal_list=subgoal_list)[0]
+        with STAGE_SECONDS.time(stage="classifier"):
+            score = classifier.predict_proba([code])[0,1] if SHOW_STATUS and classifier is not None else 0
+        with STAGE_SECONDS.time(stage="progress_model"):
+            progress = progress_model.predict_proba([code], subgoal_list=subgoal_list)[0]
 
         # print(f"Progress: {progress}; Score: {score}")
-        status = "In Progress"
-        cutoff = 0.9
-        if progress > cutoff:
-            if score > 0.75:
-                status = "Great!"
-            elif score > 0.5:
-                status = "Good"
-            else:
-                status = "Maybe Bugs"
+        cutoff = PROGRESS_CUTOFF
+        status = self.get_status(progress, score)
+
+        if format == FORMAT_JSON:
+            # Lets clients render the feedback themselves, without the HTML
+            data = {
+                "x-progress": float(progress),
+                "x-score": float(score),
+                "status": status,
+            }
+            if subgoal_list is not None:
+                data["subgoals"] = [
+                    {"name": subgoal["name"], "score": float(subgoal["score"][0])}
+                    for subgoal in subgoal_list
+                ]
+            return [
+                {
+                    "action": "ShowProgress",
+                    "data": data,
+                }
+            ]
+
         status_class = status.lower().replace(" ", "-").replace("!", "")
-        html = render_template_string(self.progress_tempalte,
+        start = time.time()
+        html = self.progress_template.render(
             progress=progress,
             score=score,
             max_score=cutoff,
@@ -204,6 +537,11 @@ class FeedbackGenerator(Resource):
             help_url=HELP_URL,
             percent=max(0, min(progress/cutoff, 1)),
         )
+        render_seconds = time.time() - start
+        with self.render_lock:
+            self.render_count += 1
+            self.render_seconds += render_seconds
+        STAGE_SECONDS.observe(render_seconds, stage="render")
         return [
             {
                 "action": "ShowDiv",
@@ -217,6 +555,17 @@ class FeedbackGenerator(Resource):
 
 fb_gen = FeedbackGenerator()
 
+def get_cache_lookups():
+    lookups = {}
+    for name, cache in [("model", fb_gen.model_cache), ("feedback", fb_gen.feedback_cache)]:
+        lookups[(name, "hit")] = cache.hits
+        lookups[(name, "miss")] = cache.misses
+    return lookups
+
+metrics.CallbackMetric(
+    'simpleaif_cache_lookups_total', 'Lookups in the model and feedback caches',
+    get_cache_lookups, type='counter', labelnames=['cache', 'result'])
+
 def generate_feedback_from_request():
     json = request.get_json()
     code = json["CodeState"]
@@ -227,12 +576,56 @@ def generate_feedback_from_request():
             return []
     else:
         print("Warning: No SubjectID provided")
-    return fb_gen.generate_feedback(problem_id, code)
+    format = json.get("format", FORMAT_HTML)
+    return fb_gen.generate_feedback(problem_id, code, format)
 
 @app.route('/', methods=['GET'])
 def hello_world():
     return 'Hello, World!'
 
+@app.route('/X-Stats/', methods=['GET'])
+def stats():
+    return get_stats()
+
+def get_stats():
+    """ The server's stats, which are shared by the Flask and ASGI apps. """
+    return {
+        "model_cache": fb_gen.model_cache.stats(),
+        "feedback_cache": fb_gen.feedback_cache.stats(),
+        "template_render": fb_gen.get_render_stats(),
+        "builds": fb_gen.build_scheduler.stats() if fb_gen.build_scheduler is not None else None,
+        "updates": fb_gen.update_scheduler.stats() if fb_gen.update_scheduler is not None else None,
+        "recent_builds": [
+            {"ProblemID": problem_id, "correct_count": correct_count, "seconds": seconds}
+            for problem_id, correct_count, seconds in fb_gen.recent_builds
+        ],
+        "model_stores": {
+            system_id: logger.model_store.stats()
+            for system_id, logger in fb_gen.loggers.items() if logger.model_store is not None
+        },
+        "profiler": profiler.stats() if profiler is not None else None,
+        "python_preprocessor_memo": PythonPreprocessor.memo_stats(),
+    }
+
+@app.route('/BatchFeedback/', methods=['POST'])
+def batch_feedback():
+    # Accepts either a list of items, or {"Items": [...], "Stream": true/false}
+    body = request.get_json()
+    items, stream = body, False
+    if isinstance(body, dict):
+        items = body.get("Items", [])
+        stream = body.get("Stream", False)
+    if not isinstance(items, list):
+        return {"error": "Items must be a list"}, 400
+    results = fb_gen.generate_batch_feedback(items)
+    if stream:
+        # Newline-delimited JSON, so large batches can be consumed as they are scored
+        return Response(
+            (json.dumps(result) + "\n" for result in results),
+            mimetype="application/x-ndjson"
+        )
+    return {"Results": sorted(results, key=lambda result: result["index"])}
+
 @app.route('/Submit/', methods=['POST'])
 def submit():
     fb_gen.log("Submit", request.get_json())
@@ -261,16 +654,39 @@ def set_starter_code():
     logger.set_starter_code(problem_id, starter_code)
     return []
 
-# Enable to test efficiency
-# @app.before_request
-# def before_request():
-#     g.start = time.time()
-
-# @app.after_request
-# def after_request(response):
-#     diff = time.time() - g.start
-#     print (diff)
-#     return response
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not METRICS_ENABLED:
+        return "Metrics are disabled; set metrics.enabled in the config", 404
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+# Requests are only timed if metrics are enabled
+if METRICS_ENABLED:
+    @app.before_request
+    def before_request():
+        g.start = time.perf_counter()
+
+    @app.after_request
+    def after_request(response):
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        REQUEST_SECONDS.observe(time.perf_counter() - g.start, route=route)
+        return response
+
+# A fraction of requests are profiled, if profiling is enabled
+if PROFILING_ENABLED:
+    @app.before_request
+    def start_profiling():
+        if not should_profile_request():
+            return
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        body = request.get_json(silent=True) if request.method == 'POST' else None
+        problem_id = body.get("ProblemID") if isinstance(body, dict) else None
+        g.profiling_token = profiler.start(route, problem_id or "none")
+
+    @app.teardown_request
+    def stop_profiling(exception):
+        if "profiling_token" in g:
+            profiler.stop(g.profiling_token)
 
 # api.add_resource(HelloWorld, '/')
 
@@ -0,0 +1,159 @@
+""" Builds the progress model and classifier of every problem (or of the given
+problems) in a ProgSnap2 dataset, and stores them in a model database that the
+server can use (see build.model_database in the server's config).
+
+The dataset is loaded and split by problem once (see PreparedDataset), and
+then the problems are built in parallel in a pool of processes.
+
+Usage (from the repository root):
+    python -m shared.bulk_build <dataset> <model database> [--problems p1 p2 ...] [--processes 4]
+
+The dataset can either be a folder of CSV files or a SQLite database.
+"""
+
+import os
+import sys
+import argparse
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from xgboost import XGBClassifier
+
+from shared.progsnap import ProgSnap2Dataset, PS2
+from shared.database import CSVDataProvider, SQLiteDataProvider
+from shared.preprocess import SimpleAIFBuilder, PreparedDataset
+from shared.data import SQLiteLogger
+
+def open_dataset(path):
+    if os.path.isdir(path):
+        return ProgSnap2Dataset(CSVDataProvider(path))
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"No dataset at {path}")
+    return ProgSnap2Dataset(SQLiteDataProvider(path))
+
+# Each worker process's copy of the PreparedDataset
+_prepared = None
+
+def _init_worker(prepared):
+    global _prepared
+    _prepared = prepared
+
+def build_problem(problem_id, args):
+    """ Builds one problem's models (in a worker process), returning the models,
+    the number of unique correct submissions, and the time taken.
+    """
+    start = time.perf_counter()
+    builder = SimpleAIFBuilder(problem_id, code_column=args.code_column, problem_id_column=args.problem_id_column)
+    builder.lang = args.lang
+    # Each process is already one of many, so XGBoost shouldn't use every core
+    builder.classifier_factory = lambda: XGBClassifier(n_jobs=args.threads)
+    builder.build(_prepared)
+    progress_model = builder.get_trained_progress_model()
+    if args.compact:
+        progress_model.compact()
+    classifier = builder.get_trained_classifier() if args.classifier else None
+    correct_count = int(builder.X_train[builder.y_train].unique().size)
+    return progress_model, classifier, correct_count, time.perf_counter() - start
+
+def bulk_build(args):
+    start = time.perf_counter()
+    prepared = PreparedDataset(open_dataset(args.dataset), problem_id_column=args.problem_id_column, code_column=args.code_column)
+    print(f"Loaded {len(prepared.submissions)} submissions for {len(prepared.get_problem_ids())} problems in {time.perf_counter() - start:.1f}s")
+    # ProblemIDs are compared as strings, which is how the server stores them
+    problem_ids = {str(problem_id): problem_id for problem_id in prepared.get_problem_ids()}
+    if args.problems:
+        for problem_id in args.problems:
+            if problem_id not in problem_ids:
+                print(f"Skipping {problem_id}: no submissions")
+        problem_ids = {key: problem_id for key, problem_id in problem_ids.items() if key in args.problems}
+
+    to_build = []
+    for key, problem_id in problem_ids.items():
+        submissions = prepared.get_submissions(problem_id)
+        correct_count = submissions[submissions[PS2.Score] >= 1][args.code_column].nunique()
+        if correct_count < args.min_correct:
+            print(f"Skipping {key}: only {correct_count} unique correct submissions")
+            continue
+        to_build.append(problem_id)
+    # The largest problems are started first, so that they don't finish last
+    to_build.sort(key=lambda problem_id: len(prepared.get_submissions(problem_id)), reverse=True)
+
+    logger = SQLiteLogger(args.database)
+    logger.create_tables()
+    pending = []
+    build_times = {}
+    failed = []
+
+    def on_built(problem_id, result):
+        progress_model, classifier, correct_count, build_time = result
+        problem_id = str(problem_id)
+        build_times[problem_id] = build_time
+        print(f"Built {problem_id} with {correct_count} unique correct submissions in {build_time:.2f}s")
+        pending.append((problem_id, progress_model, classifier, correct_count))
+        if len(pending) >= args.batch_size:
+            logger.set_many_models(pending)
+            pending.clear()
+
+    def on_failed(problem_id):
+        print(f"Failed to build {problem_id}")
+        traceback.print_exc()
+        failed.append(str(problem_id))
+
+    if args.processes == 1:
+        _init_worker(prepared)
+        for problem_id in to_build:
+            try:
+                result = build_problem(problem_id, args)
+            except Exception:
+                on_failed(problem_id)
+                continue
+            on_built(problem_id, result)
+    else:
+        # The prepared dataset is given to each worker once (and, where processes
+        # are forked, shared with them), so each task only sends a ProblemID
+        with ProcessPoolExecutor(max_workers=args.processes, initializer=_init_worker, initargs=(prepared,)) as executor:
+            futures = {
+                executor.submit(build_problem, problem_id, args): problem_id
+                for problem_id in to_build
+            }
+            for future in as_completed(futures):
+                problem_id = futures[future]
+                try:
+                    result = future.result()
+                except Exception:
+                    on_failed(problem_id)
+                    continue
+                on_built(problem_id, result)
+    if len(pending) > 0:
+        logger.set_many_models(pending)
+    logger.close()
+
+    print(f"\n{'problem':>20} {'build time':>12}")
+    for problem_id, build_time in sorted(build_times.items(), key=lambda item: item[1], reverse=True):
+        print(f"{problem_id:>20} {build_time:>10.2f}s")
+    print(f"Built {len(build_times)} problems ({len(failed)} failed) in {time.perf_counter() - start:.1f}s, "
+          f"with {sum(build_times.values()):.1f}s of total build time")
+    return build_times, failed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dataset", help="a folder of ProgSnap2 CSV files or a ProgSnap2 SQLite database")
+    parser.add_argument("database", help="the .db file to store the models in")
+    parser.add_argument("--problems", nargs="+", help="only build these ProblemIDs")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="number of problems built at once (default: one per CPU)")
+    parser.add_argument("--threads", type=int, default=1, help="number of threads each classifier is trained with")
+    parser.add_argument("--lang", choices=["python", "sql"], help="the programming language, which selects a code preprocessor")
+    parser.add_argument("--min-correct", type=int, default=1, help="skip problems with fewer unique correct submissions")
+    parser.add_argument("--batch-size", type=int, default=20, help="number of problems' models stored in each transaction")
+    parser.add_argument("--no-classifier", dest="classifier", action="store_false", help="only build progress models")
+    parser.add_argument("--no-compact", dest="compact", action="store_false",
+                        help="don't compact progress models, so that the server can update them with partial_fit")
+    parser.add_argument("--problem-id-column", default=PS2.ProblemID)
+    parser.add_argument("--code-column", default=PS2.Code)
+    args = parser.parse_args()
+    _, failed = bulk_build(args)
+    if len(failed) > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
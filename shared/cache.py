@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """ A thread-safe LRU cache bounded by the total size of its entries.
+    By default each entry has size 1, so max_size is a maximum entry count.
+    If a ttl (in seconds) is given, entries also expire that long after being put.
+    """
+
+    def __init__(self, max_size, size_of=None, ttl=None):
+        self.max_size = max_size
+        self.size_of = size_of if size_of is not None else (lambda value: 1)
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
+
+    def _get_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] is not None and entry[2] < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, value):
+        size = self.size_of(value)
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._remove(key)
+            # Never cache something that would evict the whole cache
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        if key in self._entries:
+            _, size, _ = self._entries.pop(key)
+            self.size -= size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups > 0 else 0,
+        }
+
+
+class ModelCache(LRUCache):
+    """ A per-process registry of unpickled models, keyed by database and ProblemID.
+    Each entry remembers the model version it was loaded from, so a lookup
+    with a newer version (e.g. written by another worker) is treated as a miss.
+    The size of an entry is the size of its serialized blobs, which is used as
+    an approximation of its size in memory.
+    """
+
+    def __init__(self, max_bytes):
+        super().__init__(max_bytes, size_of=lambda entry: entry[2])
+
+    def get_models(self, db_path, problem_id, version):
+        with self._lock:
+            entry = self._get_entry((db_path, problem_id))
+            if entry is None or entry[0][0] != version:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0][1]
+
+    def put_models(self, db_path, problem_id, version, models, n_bytes):
+        self.put((db_path, problem_id), (version, models, n_bytes))
+
+    def invalidate_models(self, db_path, problem_id):
+        self.invalidate((db_path, problem_id))
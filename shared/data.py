@@ -1,7 +1,14 @@
 import sqlite3
-import pickle
+import hashlib
 import os
+import threading
+import traceback
+from contextlib import contextmanager
 from shared.progsnap import PS2
+from shared.database import SUBMISSIONS_INDEX, SUBMISSIONS_INDEX_COLUMNS
+from shared.journal import EventJournal
+from shared import model_format
+from shared.metrics import DB_LOCK_WAIT_SECONDS
 
 def get(json_obj, key, default=None):
     if key in json_obj:
@@ -9,16 +16,24 @@ def get(json_obj, key, default=None):
     else:
         return default
 
+def code_hash(code):
+    return hashlib.sha256(code.encode('utf-8', 'surrogatepass')).digest()
+
 CODE_STATES_TABLE = 'CodeStates'
 MAIN_TABLE = 'MainTable'
 METADATA_TABLE = 'DatasetMetadata'
 MODELS_TABLE = 'Models'
 PROBLEM_TABLE = 'LinkProblem'
 SUBJECT_TABLE = 'LinkSubject'
+JOURNAL_TABLE = 'JournalSegments'
+PROBLEM_STATS_TABLE = 'ProblemStats'
+CORRECT_CODE_STATES_TABLE = 'ProblemCorrectCodeStates'
 
 CODE_STATES_TABLE_COLUMNS = {
     'CodeStateID': 'INTEGER PRIMARY KEY',
     'Code': 'TEXT',
+    # The SHA-256 digest of Code, which is UNIQUE, so each code state is only stored once
+    'CodeHash': 'BLOB',
 }
 
 MAIN_TABLE_COLUMNS = {
@@ -44,6 +59,7 @@ MODELS_TABLE_COLUMNS = {
     'ProgressModel': 'BLOB',
     'ClassifierModel': 'BLOB',
     'TrainingCount': 'INTEGER',
+    'Version': 'INTEGER',
 }
 
 PROBLEM_TABLE_COLUMNS = {
@@ -57,29 +73,110 @@ SUBJECT_TABLE_COLUMNS = {
     'IsInterventionGroup': 'INTEGER',
 }
 
+# Records which event journal segments have been ingested, so that replaying
+# a segment after a crash never logs its events twice
+JOURNAL_TABLE_COLUMNS = {
+    'SegmentID': 'TEXT PRIMARY KEY',
+    'EventCount': 'INTEGER',
+}
+
+# Maintained as events are logged, so that deciding whether to rebuild a
+# problem's model doesn't need to scan MainTable
+PROBLEM_STATS_TABLE_COLUMNS = {
+    'ProblemID': 'TEXT PRIMARY KEY',
+    # The number of distinct correct (Score = 1) code states
+    'CorrectCount': 'INTEGER',
+    # The CorrectCount when the models were last built
+    'LastBuildCount': 'INTEGER',
+    'LastEventTime': 'TEXT',
+}
+
+# The distinct correct code states of each problem, which has a UNIQUE index,
+# so an event only increments CorrectCount if its code state is new
+CORRECT_CODE_STATES_TABLE_COLUMNS = {
+    'ProblemID': 'TEXT',
+    'CodeStateID': 'INTEGER',
+}
+
+# How long (in seconds) a connection waits for another process's write lock
+BUSY_TIMEOUT = 30
+
+# WAL journaling lets readers proceed while another process writes, and
+# with it synchronous=NORMAL only syncs at checkpoints, rather than per commit.
+CONNECTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    # Negative values are in KiB, so this is a 16MB page cache per connection
+    'cache_size': -16000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
 
 class SQLiteLogger:
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, model_cache=None, model_store=None):
         dirname = os.path.dirname(os.path.abspath(db_path))
         os.makedirs(dirname, exist_ok=True)
         self.db_path = db_path
+        # Each thread reuses its own connection, since sqlite3 connections
+        # should not be shared between threads
+        self.__local = threading.local()
+        self.__connections = []
+        self.__connections_lock = threading.Lock()
+        self.__pid = os.getpid()
+        # An optional ModelCache, shared between loggers, to avoid unpickling
+        # models on every call to get_models
+        self.model_cache = model_cache
+        # An optional SharedModelStore, which server processes map models from,
+        # rather than each reading them from the database
+        self.model_store = model_store
+        self.journal = None
         self.create_tables()
 
     def __connect(self):
-        # if self.conn is not None:
-        #     return self.conn
-        return sqlite3.connect(self.db_path)
-
-    # TODO: this won't work with "with" statements
-    # def begin_batch(self):
-    #     self.conn = sqlite3.connect(self.db_path)
-    #     self.cursor = self.conn.cursor()
-
-    # def end_batch(self):
-    #     self.conn.commit()
-    #     self.conn.close()
-    #     self.conn = None
+        # Connections can't be used across a fork (e.g. by gunicorn workers)
+        if self.__pid != os.getpid():
+            self.__local = threading.local()
+            self.__connections = []
+            self.__pid = os.getpid()
+        conn = getattr(self.__local, 'conn', None)
+        if conn is not None:
+            return conn
+        # Only the creating thread uses this connection, but close() may be
+        # called from another thread
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        for pragma, value in CONNECTION_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        self.__local.conn = conn
+        with self.__connections_lock:
+            self.__connections.append(conn)
+        return conn
+
+    def close(self):
+        with self.__connections_lock:
+            for conn in self.__connections:
+                conn.close()
+            self.__connections = []
+        self.__local = threading.local()
+
+    @contextmanager
+    def __transaction(self):
+        conn = self.__connect()
+        # Joining a transaction that is already open on this thread
+        if conn.in_transaction:
+            yield conn.cursor()
+            return
+        # Take the write lock up front, so a transaction that reads before it
+        # writes can't fail to upgrade its lock while another process writes
+        with DB_LOCK_WAIT_SECONDS.time(database=os.path.basename(self.db_path)):
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn.cursor()
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
 
     def __create_table(self, table_name, column_map):
         column_text = [f"`{k}` {v}" for k, v in column_map.items()]
@@ -87,6 +184,19 @@ class SQLiteLogger:
             c = conn.cursor()
             c.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({','.join(column_text)})")
             conn.commit()
+        self.__add_missing_columns(table_name, column_map)
+
+    def __add_missing_columns(self, table_name, column_map):
+        # Databases created by older versions may be missing newer columns
+        with self.__connect() as conn:
+            c = conn.cursor()
+            c.execute(f"PRAGMA table_info({table_name})")
+            existing_columns = set(row[1] for row in c.fetchall())
+            for column, column_type in column_map.items():
+                if column in existing_columns:
+                    continue
+                c.execute(f"ALTER TABLE {table_name} ADD COLUMN `{column}` {column_type}")
+            conn.commit()
 
     def create_tables(self):
         self.__create_table(MAIN_TABLE, MAIN_TABLE_COLUMNS)
@@ -97,13 +207,85 @@ class SQLiteLogger:
         self.__add_metadata()
         self.__create_table(PROBLEM_TABLE, PROBLEM_TABLE_COLUMNS)
         self.__create_table(SUBJECT_TABLE, SUBJECT_TABLE_COLUMNS)
-        self.__add_code_index()
-
-    def __add_code_index(self):
-        with self.__connect() as conn:
-            c = conn.cursor()
-            c.execute(f"CREATE INDEX IF NOT EXISTS idx_Code ON {CODE_STATES_TABLE} (Code)")
-            conn.commit()
+        self.__create_table(JOURNAL_TABLE, JOURNAL_TABLE_COLUMNS)
+        self.__add_code_hash_index()
+        self.__add_problem_stats()
+        with self.__transaction() as c:
+            c.execute(f"CREATE INDEX IF NOT EXISTS {SUBMISSIONS_INDEX} ON {MAIN_TABLE} ({','.join(SUBMISSIONS_INDEX_COLUMNS)})")
+
+    def __add_code_hash_index(self):
+        with self.__transaction() as c:
+            c.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_CodeHash'")
+            if c.fetchone() is not None:
+                return
+            # Older databases deduplicated code states using an index on the full
+            # Code text, so we backfill hashes and replace that index
+            hashes = set()
+            last_id = -1
+            while True:
+                c.execute(f"SELECT CodeStateID, Code FROM {CODE_STATES_TABLE} WHERE CodeStateID > ? AND Code IS NOT NULL ORDER BY CodeStateID LIMIT 1000", (last_id,))
+                rows = c.fetchall()
+                if len(rows) == 0:
+                    break
+                last_id = rows[-1][0]
+                updates = []
+                for code_state_id, code in rows:
+                    digest = code_hash(code)
+                    # Duplicate code states (from concurrent inserts) keep a NULL hash,
+                    # so that only the first is matched by new events
+                    if digest in hashes:
+                        continue
+                    hashes.add(digest)
+                    updates.append((digest, code_state_id))
+                c.executemany(f"UPDATE {CODE_STATES_TABLE} SET CodeHash = ? WHERE CodeStateID = ?", updates)
+            c.execute("DROP INDEX IF EXISTS idx_Code")
+            c.execute(f"CREATE UNIQUE INDEX idx_CodeHash ON {CODE_STATES_TABLE} (CodeHash)")
+
+    def __add_problem_stats(self):
+        with self.__transaction() as c:
+            c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (PROBLEM_STATS_TABLE,))
+            if c.fetchone() is not None:
+                return
+            for table_name, column_map in [
+                (PROBLEM_STATS_TABLE, PROBLEM_STATS_TABLE_COLUMNS),
+                (CORRECT_CODE_STATES_TABLE, CORRECT_CODE_STATES_TABLE_COLUMNS),
+            ]:
+                column_text = [f"`{k}` {v}" for k, v in column_map.items()]
+                c.execute(f"CREATE TABLE {table_name} ({','.join(column_text)})")
+            c.execute(f"CREATE UNIQUE INDEX idx_ProblemCorrectCodeState ON {CORRECT_CODE_STATES_TABLE} (ProblemID, CodeStateID)")
+            # Backfill the stats of events logged by older versions
+            c.execute(f"INSERT INTO {CORRECT_CODE_STATES_TABLE} (ProblemID, CodeStateID) "
+                      f"SELECT DISTINCT ProblemID, CodeStateID FROM {MAIN_TABLE} WHERE ProblemID IS NOT NULL AND Score = 1")
+            c.execute(f"INSERT INTO {PROBLEM_STATS_TABLE} (ProblemID, CorrectCount, LastEventTime) "
+                      f"SELECT ProblemID, 0, MAX(ServerTimestamp) FROM {MAIN_TABLE} WHERE ProblemID IS NOT NULL GROUP BY ProblemID")
+            c.execute(f"INSERT OR IGNORE INTO {PROBLEM_STATS_TABLE} (ProblemID, CorrectCount) SELECT ProblemID, 0 FROM {MODELS_TABLE}")
+            c.execute(f"UPDATE {PROBLEM_STATS_TABLE} SET "
+                      f"CorrectCount = (SELECT COUNT(*) FROM {CORRECT_CODE_STATES_TABLE} s WHERE s.ProblemID = {PROBLEM_STATS_TABLE}.ProblemID), "
+                      f"LastBuildCount = (SELECT TrainingCount FROM {MODELS_TABLE} m WHERE m.ProblemID = {PROBLEM_STATS_TABLE}.ProblemID)")
+
+    def __update_problem_stats(self, c, problem_rows):
+        # problem_rows is a list of (ProblemID, CodeStateID, ServerTimestamp, is_correct)
+        correct_by_problem = {}
+        last_event_times = {}
+        for problem_id, code_state_id, timestamp, is_correct in problem_rows:
+            correct = correct_by_problem.setdefault(problem_id, [])
+            if is_correct:
+                correct.append((problem_id, code_state_id))
+            if timestamp is not None:
+                last_event_times[problem_id] = max(timestamp, last_event_times.get(problem_id, timestamp))
+        for problem_id, correct in correct_by_problem.items():
+            c.execute(f"INSERT OR IGNORE INTO {PROBLEM_STATS_TABLE} (ProblemID, CorrectCount) VALUES (?, 0)", (problem_id,))
+            new_count = 0
+            if len(correct) > 0:
+                # Only code states that weren't already correct for this problem are inserted
+                c.executemany(f"INSERT OR IGNORE INTO {CORRECT_CODE_STATES_TABLE} (ProblemID, CodeStateID) VALUES (?, ?)", correct)
+                new_count = c.rowcount
+            timestamp = last_event_times.get(problem_id)
+            c.execute(
+                f"UPDATE {PROBLEM_STATS_TABLE} SET CorrectCount = CorrectCount + ?, "
+                f"LastEventTime = MAX(IFNULL(LastEventTime, ?), ?) WHERE ProblemID = ?",
+                (new_count, timestamp, timestamp, problem_id)
+            )
 
     def __add_metadata(self):
         # get the number of rows in the metadata table
@@ -146,36 +328,111 @@ class SQLiteLogger:
             c.execute(f"DELETE FROM {table_name}")
             conn.commit()
 
-    def __get_codestate_id(self, code_state):
-        # TODO: This could be more efficient and concurrency-safe
-        # using INSERT OR IGNORE, with a UNIQUE Code column, but
-        # I'm keeping it this way for now for backwards compatibility
-        result = None
-        with self.__connect() as conn:
-            c = conn.cursor()
-            c.execute(f"SELECT CodeStateID FROM {CODE_STATES_TABLE} WHERE Code = ?", (code_state,))
-            result = c.fetchone()
-        if result is None:
-            return self.__insert_map(CODE_STATES_TABLE, {'Code': code_state})
-        return result[0]
+    def enable_journal(self, directory, flush_interval=1.0, flush_size=500, fsync=False):
+        """ Appends events to a journal in the given directory, rather than
+        committing each one, and ingests them in batches on a background thread.
+        """
+        self.journal = EventJournal(
+            directory, self.__ingest_journal_segment,
+            flush_interval=flush_interval, flush_size=flush_size, fsync=fsync
+        )
+
+    def flush_journal(self):
+        if self.journal is not None:
+            self.journal.flush()
+
+    def __ingest_journal_segment(self, records, segment_id):
+        with self.__transaction() as c:
+            c.execute(f"SELECT 1 FROM {JOURNAL_TABLE} WHERE SegmentID = ?", (segment_id,))
+            if c.fetchone() is not None:
+                return
+            self.__insert_events(c, [(record['EventType'], record['Row']) for record in records])
+            c.execute(f"INSERT INTO {JOURNAL_TABLE} (SegmentID, EventCount) VALUES (?, ?)", (segment_id, len(records)))
+
+    def __get_codestate_ids(self, c, code_states):
+        hashes = {}
+        for code_state in code_states:
+            if code_state is not None and code_state not in hashes:
+                hashes[code_state] = code_hash(code_state)
+        # The UNIQUE hash index makes this safe when multiple processes insert the same code
+        c.executemany(
+            f"INSERT OR IGNORE INTO {CODE_STATES_TABLE} (Code, CodeHash) VALUES (?, ?)",
+            hashes.items()
+        )
+        ids_by_hash = {}
+        unique_hashes = list(hashes.values())
+        # Stay under SQLite's limit on the number of query parameters
+        for start in range(0, len(unique_hashes), 500):
+            chunk = unique_hashes[start:start + 500]
+            placeholders = ','.join(['?'] * len(chunk))
+            c.execute(f"SELECT CodeHash, CodeStateID FROM {CODE_STATES_TABLE} WHERE CodeHash IN ({placeholders})", chunk)
+            ids_by_hash.update(c.fetchall())
+        return {code_state: ids_by_hash[digest] for code_state, digest in hashes.items()}
+
+    def __insert_events(self, c, events):
+        code_states = [get(row_dict, 'CodeState') for _, row_dict in events]
+        code_state_ids = self.__get_codestate_ids(c, code_states)
+        rows = []
+        problem_rows = []
+        for (event_type, row_dict), code_state in zip(events, code_states):
+            if code_state is None:
+                # Missing code never matches an existing code state
+                c.execute(f"INSERT INTO {CODE_STATES_TABLE} (Code) VALUES (NULL)")
+                code_state_id = c.lastrowid
+            else:
+                code_state_id = code_state_ids[code_state]
+            main_table_map = {
+                PS2.EventType: event_type,
+                PS2.CodeStateID: code_state_id,
+                # I haven't gotten order to work, but it's optional so ignoring
+                # "Order": f"(SELECT IFNULL(MAX(`Order`), 0) + 1 FROM {MAIN_TABLE})"
+            }
+            for key in MAIN_TABLE_COLUMNS:
+                if key in main_table_map:
+                    continue
+                main_table_map[key] = get(row_dict, key)
+            del main_table_map[PS2.EventID]
+            rows.append(main_table_map)
+            problem_id = main_table_map[PS2.ProblemID]
+            if problem_id is not None:
+                problem_rows.append((
+                    problem_id, code_state_id, main_table_map[PS2.ServerTimestamp],
+                    self.__is_correct(row_dict)
+                ))
+        if len(rows) == 0:
+            return
+        columns = list(rows[0].keys())
+        column_text = '`' + '`,`'.join(columns) + '`'
+        values = ','.join(['?'] * len(columns))
+        query = f"INSERT INTO {MAIN_TABLE} ({column_text}) VALUES ({values})"
+        c.executemany(query, [tuple(row[column] for column in columns) for row in rows])
+        self.__update_problem_stats(c, problem_rows)
+
+    @staticmethod
+    def __is_correct(row_dict):
+        # Matches the "Score = 1" used when counting correct submissions
+        try:
+            return float(get(row_dict, PS2.Score)) == 1
+        except (TypeError, ValueError):
+            return False
 
     def log_event(self, event_type, row_dict):
-        code_state = get(row_dict, 'CodeState')
-        code_state_id = self.__get_codestate_id(code_state)
-        # print(code_state_id)
-        main_table_map = {
-            PS2.EventType: event_type,
-            PS2.CodeStateID: code_state_id,
-            # I haven't gotten order to work, but it's optional so ignoring
-            # "Order": f"(SELECT IFNULL(MAX(`Order`), 0) + 1 FROM {MAIN_TABLE})"
-        }
-        for key in MAIN_TABLE_COLUMNS:
-            if key in main_table_map:
-                continue
-            main_table_map[key] = get(row_dict, key)
-        del main_table_map[PS2.EventID]
-        # print (main_table_map)
-        self.__insert_map(MAIN_TABLE, main_table_map)
+        if self.journal is not None:
+            # Mark problems with new correct submissions, so that
+            # should_rebuild_model can flush them before counting
+            key = None
+            problem_id = get(row_dict, PS2.ProblemID)
+            if problem_id is not None and SQLiteLogger.__is_correct(row_dict):
+                key = str(problem_id)
+            self.journal.append({'EventType': event_type, 'Row': row_dict}, key)
+            return
+        self.log_events([(event_type, row_dict)])
+
+    def log_events(self, events):
+        """ Logs a list of (event_type, row_dict) pairs in a single transaction.
+        """
+        with self.__transaction() as c:
+            self.__insert_events(c, events)
 
     def get_starter_code(self, problem_id):
         with self.__connect() as conn:
@@ -187,62 +444,159 @@ class SQLiteLogger:
             return result[0]
 
     def set_starter_code(self, problem_id, starter_code):
-        with self.__connect() as conn:
-            c = conn.cursor()
+        with self.__transaction() as c:
             query = f"INSERT OR IGNORE INTO {PROBLEM_TABLE} (ProblemID) VALUES (?);"
             c.execute(query, (problem_id,))
             query = f"UPDATE {PROBLEM_TABLE} SET StarterCode = ? WHERE ProblemID = ?;"
             c.execute(query, (starter_code, problem_id))
-            conn.commit()
 
     def set_subgoals(self, problem_id, subgoals):
-        with self.__connect() as conn:
-            c = conn.cursor()
+        with self.__transaction() as c:
             query = f"INSERT OR IGNORE INTO {PROBLEM_TABLE} (ProblemID) VALUES (?);"
             c.execute(query, (problem_id,))
             query = f"UPDATE {PROBLEM_TABLE} SET Subgoals = ? WHERE ProblemID = ?;"
             c.execute(query, (subgoals, problem_id))
-            conn.commit()
 
     def __blobify(self, obj):
-        pdata = pickle.dumps(obj)
+        # Models are pickled if they can't be stored in the compact format
+        pdata = model_format.dumps_or_pickle(obj)
         return sqlite3.Binary(pdata)
 
     def __deblobify(self, blob):
-        return pickle.loads(blob)
+        return model_format.loads_or_unpickle(blob)
 
     def set_models(self, problem_id, progress_model, classifier_model, training_correct_count):
-         with self.__connect() as conn:
-            c = conn.cursor()
+        self.set_many_models([(problem_id, progress_model, classifier_model, training_correct_count)])
+
+    def set_many_models(self, models):
+        """ Stores the models of many problems in a single transaction, where each
+        item is a (problem_id, progress_model, classifier_model, training_correct_count) tuple.
+        """
+        rows = [
+            (self.__blobify(progress_model), self.__blobify(classifier_model), training_correct_count, problem_id)
+            for problem_id, progress_model, classifier_model, training_correct_count in models
+        ]
+        problem_ids = [(row[3],) for row in rows]
+        with self.__transaction() as c:
             query = f"INSERT OR IGNORE INTO {MODELS_TABLE} (ProblemID, ProgressModel, ClassifierModel) VALUES (?,NULL,NULL);"
-            c.execute(query, (problem_id,))
-            query = f"UPDATE {MODELS_TABLE} SET ProgressModel = ?, ClassifierModel = ?, TrainingCount = ? WHERE ProblemID = ?;"
-            c.execute(query, (self.__blobify(progress_model), self.__blobify(classifier_model), training_correct_count, problem_id))
-            conn.commit()
+            c.executemany(query, problem_ids)
+            # Bump the version so that cached copies of the old models are invalidated
+            query = f"UPDATE {MODELS_TABLE} SET ProgressModel = ?, ClassifierModel = ?, TrainingCount = ?, Version = IFNULL(Version, 0) + 1 WHERE ProblemID = ?;"
+            c.executemany(query, rows)
+            c.executemany(f"INSERT OR IGNORE INTO {PROBLEM_STATS_TABLE} (ProblemID, CorrectCount) VALUES (?, 0)", problem_ids)
+            c.executemany(f"UPDATE {PROBLEM_STATS_TABLE} SET LastBuildCount = ? WHERE ProblemID = ?", [(row[2], row[3]) for row in rows])
+            versions = [self.__get_model_version(c, problem_id) for (problem_id,) in problem_ids]
+        for row, version in zip(rows, versions):
+            self.__publish_models(row[3], version, row[0], row[1])
+        if self.model_cache is not None:
+            for (problem_id,) in problem_ids:
+                self.model_cache.invalidate_models(self.db_path, problem_id)
+
+    def update_progress_model(self, problem_id, progress_model, version):
+        """ Replaces the progress model of the given version (e.g. after updating it
+        with partial_fit), without changing the TrainingCount. Returns False, and
+        doesn't update it, if the models have since been replaced.
+        """
+        progress_blob = self.__blobify(progress_model)
+        with self.__transaction() as c:
+            query = f"UPDATE {MODELS_TABLE} SET ProgressModel = ?, Version = IFNULL(Version, 0) + 1 WHERE ProblemID = ? AND IFNULL(Version, 0) = ?;"
+            c.execute(query, (progress_blob, problem_id, version))
+            updated = c.rowcount == 1
+            if updated and self.model_store is not None:
+                c.execute(f"SELECT ClassifierModel FROM {MODELS_TABLE} WHERE ProblemID = ?", (problem_id,))
+                classifier_blob = c.fetchone()[0]
+        if updated:
+            if self.model_store is not None:
+                self.__publish_models(problem_id, version + 1, progress_blob, classifier_blob)
+            if self.model_cache is not None:
+                self.model_cache.invalidate_models(self.db_path, problem_id)
+        return updated
 
     def should_rebuild_model(self, problem_id, min_correct, increment):
+        if self.journal is not None and self.journal.is_dirty(str(problem_id)):
+            try:
+                self.journal.flush()
+            except Exception:
+                # The background thread will retry, so just count what we have
+                print("Failed to flush event journal")
+                traceback.print_exc()
         with self.__connect() as conn:
             c = conn.cursor()
-            c.execute(f"SELECT COUNT(DISTINCT({PS2.CodeStateID})) FROM {MAIN_TABLE} WHERE ProblemID = ? AND Score = 1", (problem_id,))
+            c.execute(f"SELECT CorrectCount, LastBuildCount FROM {PROBLEM_STATS_TABLE} WHERE ProblemID = ?", (problem_id,))
             result = c.fetchone()
             if result is None or result[0] < min_correct:
                 return False
-            current_correct_count = result[0]
-
-            c.execute(f"SELECT TrainingCount FROM {MODELS_TABLE} WHERE ProblemID = ?", (problem_id,))
-            result = c.fetchone()
-            if result is None:
+            current_correct_count, last_build_count = result
+            if last_build_count is None:
                 return True
-            return current_correct_count >= result[0] + increment
+            return current_correct_count >= last_build_count + increment
+
+    def get_model_version(self, problem_id):
+        with self.__connect() as conn:
+            return self.__get_model_version(conn.cursor(), problem_id)
+
+    def __get_model_version(self, c, problem_id):
+        c.execute(f"SELECT IFNULL(Version, 0) FROM {MODELS_TABLE} WHERE ProblemID = ?", (problem_id,))
+        result = c.fetchone()
+        if result is None:
+            return None
+        return result[0]
 
     def get_models(self, problem_id):
+        return self.get_versioned_models(problem_id)[1]
+
+    def get_versioned_models(self, problem_id):
+        """ Returns the models for the given problem, along with their version,
+        which changes whenever they are rebuilt, or (None, None) if there are none.
+        """
+        if self.model_cache is None and self.model_store is None:
+            version, models, _ = self.__load_models(problem_id)
+            return version, models
+        version = self.get_model_version(problem_id)
+        if version is None:
+            return None, None
+        if self.model_cache is not None:
+            models = self.model_cache.get_models(self.db_path, problem_id, version)
+            if models is not None:
+                return version, models
+        models = None
+        if self.model_store is not None:
+            try:
+                models, n_bytes = self.model_store.load(problem_id, version)
+            except Exception:
+                print(f"Failed to load {problem_id} from the model store")
+                traceback.print_exc()
+        if models is None:
+            version, models, n_bytes = self.__load_models(problem_id)
+        if models is not None and self.model_cache is not None:
+            self.model_cache.put_models(self.db_path, problem_id, version, models, n_bytes)
+        return version, models
+
+    def __load_models(self, problem_id):
         with self.__connect() as conn:
             c = conn.cursor()
-            c.execute(f"SELECT ProgressModel, ClassifierModel FROM {MODELS_TABLE} WHERE ProblemID = ?", (problem_id,))
+            c.execute(f"SELECT IFNULL(Version, 0), ProgressModel, ClassifierModel FROM {MODELS_TABLE} WHERE ProblemID = ?", (problem_id,))
             result = c.fetchone()
             if result is None:
-                return None
-            return self.__deblobify(result[0]), self.__deblobify(result[1])
+                return None, None, 0
+            version, progress_blob, classifier_blob = result
+        if self.model_store is not None:
+            # e.g. models stored before the store was used, or by another tool
+            published_version = self.model_store.get_version(problem_id)
+            if published_version is None or published_version < version:
+                self.__publish_models(problem_id, version, progress_blob, classifier_blob)
+        n_bytes = len(progress_blob or b'') + len(classifier_blob or b'')
+        return version, (self.__deblobify(progress_blob), self.__deblobify(classifier_blob)), n_bytes
+
+    def __publish_models(self, problem_id, version, progress_blob, classifier_blob):
+        if self.model_store is None:
+            return
+        try:
+            self.model_store.publish(problem_id, version, progress_blob, classifier_blob)
+        except OSError:
+            # Processes will keep reading these models from the database
+            print(f"Failed to publish models for {problem_id}")
+            traceback.print_exc()
 
     def get_or_set_subject_condition(self, subject_id, condition_to_set):
         if subject_id is None:
@@ -251,10 +605,12 @@ class SQLiteLogger:
             c = conn.cursor()
             c.execute(f"SELECT IsInterventionGroup FROM {SUBJECT_TABLE} WHERE SubjectID = ?", (subject_id,))
             result = c.fetchone()
-            if result is None:
-                self.__insert_map(SUBJECT_TABLE, {
-                    'SubjectID': subject_id,
-                    'IsInterventionGroup': condition_to_set,
-                })
-                return condition_to_set
-            return result[0]
+            if result is not None:
+                return result[0]
+        # Another worker may assign this subject between our read and write,
+        # so only the first assignment is kept
+        with self.__transaction() as c:
+            query = f"INSERT OR IGNORE INTO {SUBJECT_TABLE} (SubjectID, IsInterventionGroup) VALUES (?, ?);"
+            c.execute(query, (subject_id, condition_to_set))
+            c.execute(f"SELECT IsInterventionGroup FROM {SUBJECT_TABLE} WHERE SubjectID = ?", (subject_id,))
+            return c.fetchone()[0]
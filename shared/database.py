@@ -5,6 +5,41 @@ import pandas as pd
 from pandas import DataFrame
 from shared.progsnap import PS2, EventType
 
+# Covers the filters of get_submissions, so matching events can be found
+# without scanning the main table
+SUBMISSIONS_INDEX = 'idx_Submissions'
+SUBMISSIONS_INDEX_COLUMNS = [PS2.ProblemID, PS2.EventType, PS2.Score, PS2.CodeStateID]
+
+def single_event_id_range(since_event_ids, until_event_ids):
+    for event_ids in [since_event_ids, until_event_ids]:
+        if event_ids is not None and len(event_ids) != 1:
+            raise ValueError("A single main table needs a single EventID")
+    return (
+        since_event_ids[0] if since_event_ids is not None else None,
+        until_event_ids[0] if until_event_ids is not None else None,
+    )
+
+def filter_submissions(main_table, code_states, problem_id=None, event_types=None, scored_only=False,
+                       problem_id_column=PS2.ProblemID, code_column=PS2.Code,
+                       since_event_ids=None, until_event_ids=None) -> DataFrame:
+    """ Filters a main table in memory and joins it with its code states.
+    See PS2DataProvider.get_submissions.
+    """
+    since, until = single_event_id_range(since_event_ids, until_event_ids)
+    if since is not None:
+        main_table = main_table[main_table[PS2.EventID] > since]
+    if until is not None:
+        main_table = main_table[main_table[PS2.EventID] <= until]
+    if problem_id is not None:
+        main_table = main_table[main_table[problem_id_column] == problem_id]
+    if event_types is not None:
+        main_table = main_table[main_table[PS2.EventType].isin(event_types)]
+    if scored_only:
+        main_table = main_table[~main_table[PS2.Score].isna()]
+    columns = [column for column in [PS2.EventID, problem_id_column, PS2.Score] if column in main_table.columns]
+    merged = pd.merge(main_table, code_states, on=PS2.CodeStateID)
+    return merged[columns + [code_column]]
+
 class PS2DataProvider(ABC):
 
     @abstractmethod
@@ -27,6 +62,27 @@ class PS2DataProvider(ABC):
     def get_link_table_names(self) -> list[str]:
         pass
 
+    def get_submissions(self, problem_id=None, event_types=None, scored_only=False,
+                        problem_id_column=PS2.ProblemID, code_column=PS2.Code,
+                        since_event_ids=None, until_event_ids=None) -> DataFrame:
+        """ Returns the EventID, problem ID, Score and code of each event, optionally
+        only for the given problem, with one of the given event types, or with a Score.
+        Events can also be limited to those after since_event_ids and up to (and
+        including) until_event_ids, which have one EventID per main table (see
+        get_max_event_ids). By default, this filters the full tables in memory.
+        """
+        return filter_submissions(
+            self.get_main_table(), self.get_code_states_table(), problem_id, event_types,
+            scored_only, problem_id_column, code_column, since_event_ids, until_event_ids
+        )
+
+    def get_max_event_ids(self) -> list:
+        """ Returns the largest EventID in each of this provider's main tables, for
+        use with get_submissions, or None if this provider can't read a range of
+        events without reading the full tables.
+        """
+        return None
+
 class CSVDataProvider(PS2DataProvider):
     MAIN_TABLE_FILE = 'MainTable.csv'
     METADATA_TABLE_FILE = 'DatasetMetadata.csv'
@@ -137,11 +193,99 @@ class SQLiteDataProvider(PS2DataProvider):
         except:
             return None
 
+    def __get_main_table_columns(self):
+        rows = self.__connect().execute(f"PRAGMA table_info({self.main_table})").fetchall()
+        return [row[1] for row in rows]
+
+    def create_submissions_index(self):
+        try:
+            with self.__connect() as con:
+                con.execute(f"CREATE INDEX IF NOT EXISTS {SUBMISSIONS_INDEX} ON {self.main_table} ({','.join(SUBMISSIONS_INDEX_COLUMNS)})")
+        except sqlite3.OperationalError as e:
+            # e.g. the database is read-only, which just makes queries slower
+            print(f"Could not index {self.path}: {e}")
+
+    def get_max_event_ids(self):
+        if PS2.EventID not in self.__get_main_table_columns():
+            return None
+        # EventIDs start at 1, so this is 0 if there are no events
+        result = self.__connect().execute(f"SELECT IFNULL(MAX(`{PS2.EventID}`), 0) FROM {self.main_table}").fetchone()
+        return [result[0]]
+
+    def get_submissions(self, problem_id=None, event_types=None, scored_only=False,
+                        problem_id_column=PS2.ProblemID, code_column=PS2.Code,
+                        since_event_ids=None, until_event_ids=None):
+        # Filters and joins in SQL, so only the matching code is read
+        columns = self.__get_main_table_columns()
+        if problem_id_column == PS2.ProblemID:
+            self.create_submissions_index()
+        conditions = []
+        params = []
+        since, until = single_event_id_range(since_event_ids, until_event_ids)
+        if since is not None:
+            conditions.append(f"m.`{PS2.EventID}` > ?")
+            params.append(since)
+        if until is not None:
+            conditions.append(f"m.`{PS2.EventID}` <= ?")
+            params.append(until)
+        if problem_id is not None:
+            conditions.append(f"m.`{problem_id_column}` = ?")
+            params.append(problem_id)
+        if event_types is not None:
+            conditions.append(f"m.`{PS2.EventType}` IN ({','.join(['?'] * len(event_types))})")
+            params.extend(event_types)
+        if scored_only:
+            conditions.append(f"m.`{PS2.Score}` IS NOT NULL")
+        selected = [f"m.`{column}`" for column in [PS2.EventID, problem_id_column, PS2.Score] if column in columns]
+        selected.append(f"c.`{code_column}`")
+        query = (
+            f"SELECT {','.join(selected)} FROM {self.main_table} m "
+            f"JOIN {self.code_states_table} c ON m.`{PS2.CodeStateID}` = c.`{PS2.CodeStateID}`"
+        )
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        # Matches the order of the main table when it is read in full
+        if PS2.Order in columns:
+            query += f" ORDER BY m.`{PS2.Order}`"
+        elif PS2.EventID in columns:
+            query += f" ORDER BY m.`{PS2.EventID}`"
+        return pd.read_sql_query(query, self.__connect(), params=params)
+
 class MultiDataProvider(PS2DataProvider):
+    # Code state IDs aren't recoded across providers (see get_code_states_table),
+    # so get_submissions uses the default in-memory filtering of the merged tables
+
     def __init__(self, providers: list[SQLiteDataProvider]) -> None:
         super().__init__()
         self.providers = providers
 
+    def get_max_event_ids(self):
+        # One EventID for each provider, since their EventIDs overlap
+        max_event_ids = []
+        for p in self.providers:
+            provider_ids = p.get_max_event_ids()
+            if provider_ids is None or len(provider_ids) != 1:
+                return None
+            max_event_ids.extend(provider_ids)
+        return max_event_ids
+
+    def get_submissions(self, problem_id=None, event_types=None, scored_only=False,
+                        problem_id_column=PS2.ProblemID, code_column=PS2.Code,
+                        since_event_ids=None, until_event_ids=None):
+        if since_event_ids is None and until_event_ids is None:
+            return super().get_submissions(problem_id, event_types, scored_only, problem_id_column, code_column)
+        # Each provider's range of events is read using its own EventIDs, and
+        # joined with its own code states
+        n_providers = len(self.providers)
+        since_event_ids = since_event_ids if since_event_ids is not None else [None] * n_providers
+        until_event_ids = until_event_ids if until_event_ids is not None else [None] * n_providers
+        if len(since_event_ids) != n_providers or len(until_event_ids) != n_providers:
+            raise ValueError("Expected one EventID for each provider")
+        return self.merge_dataframes([
+            p.get_submissions(problem_id, event_types, scored_only, problem_id_column, code_column, [since], [until])
+            for p, since, until in zip(self.providers, since_event_ids, until_event_ids)
+        ]).reset_index(drop=True)
+
     def merge_dataframes(self, dfs: list[DataFrame]) -> DataFrame:
         return pd.concat(dfs)
 
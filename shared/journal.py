@@ -0,0 +1,217 @@
+import os
+import json
+import uuid
+import time
+import atexit
+import threading
+import traceback
+try:
+    import fcntl
+except ImportError:
+    # File locks are only used to recover journals left behind by other
+    # processes, which isn't supported without fcntl (e.g. on Windows)
+    fcntl = None
+
+JOURNAL_SUFFIX = '.journal'
+SEGMENT_SUFFIX = '.segment'
+
+class EventJournal:
+    """ An append-only file of records, which a background thread periodically
+    hands to an ingest function in batches.
+
+    Each process appends to its own live journal file. To flush, the live file
+    is renamed to a uniquely named segment, and the segment's records are passed
+    to ingest_function(records, segment_id), which must ignore segment IDs it
+    has already ingested. The segment is only deleted once it has been ingested,
+    so segments (and the live files of dead processes) left behind by a crash
+    are replayed by recover() without being ingested twice.
+    """
+
+    def __init__(self, directory, ingest_function, flush_interval=1.0, flush_size=500,
+                 fsync=False, recover_interval=60):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.ingest_function = ingest_function
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.fsync = fsync
+        self.recover_interval = recover_interval
+        self.pending = 0
+        self._dirty_keys = set()
+        # The keys of each of this process's segments that hasn't been ingested yet
+        self._segment_keys = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._open_live_file()
+        self.recover()
+        self._thread = threading.Thread(target=self._run, name="aif-journal", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _open_live_file(self):
+        self._live_path = self._path(f"{os.getpid()}-{uuid.uuid4().hex}{JOURNAL_SUFFIX}")
+        self._live_file = open(self._live_path, 'a', encoding='utf-8')
+        if fcntl is not None:
+            # Held for as long as this process owns the file
+            fcntl.flock(self._live_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.pending = 0
+
+    def append(self, record, key=None):
+        """ Appends a record to the journal. If a key is given, is_dirty(key)
+        will be True until the record has been flushed.
+        """
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            if self._closed:
+                raise ValueError("Cannot append to a closed journal")
+            self._live_file.write(line)
+            self._live_file.flush()
+            if self.fsync:
+                os.fsync(self._live_file.fileno())
+            self.pending += 1
+            if key is not None:
+                self._dirty_keys.add(key)
+            full = self.pending >= self.flush_size
+        if full:
+            self._wake.set()
+
+    def is_dirty(self, key):
+        with self._lock:
+            if key in self._dirty_keys:
+                return True
+            return any(key in keys for keys in self._segment_keys.values())
+
+    def _rotate(self):
+        with self._lock:
+            if self.pending == 0:
+                return None
+            segment_path = self._live_path[:-len(JOURNAL_SUFFIX)] + SEGMENT_SUFFIX
+            if fcntl is not None:
+                # Rename before closing, so our lock is never released on the live file
+                os.replace(self._live_path, segment_path)
+                self._live_file.close()
+            else:
+                self._live_file.close()
+                os.replace(self._live_path, segment_path)
+            # The keys stay dirty until the segment has been ingested
+            self._segment_keys[segment_path] = self._dirty_keys
+            self._dirty_keys = set()
+            self._open_live_file()
+        return segment_path
+
+    def flush(self):
+        """ Synchronously ingests all records appended so far.
+        """
+        with self._flush_lock:
+            self._rotate()
+            # Also retries earlier segments that failed to ingest, in order
+            for segment_path in list(self._segment_keys):
+                self._ingest_segment(segment_path)
+
+    def _ingest_segment(self, segment_path):
+        segment_id = os.path.basename(segment_path)[:-len(SEGMENT_SUFFIX)]
+        records = []
+        try:
+            with open(segment_path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # A partially written record from a crash, which was never acknowledged
+                        print(f"Skipping corrupt record in journal segment {segment_id}")
+        except FileNotFoundError:
+            # Another process has already ingested this segment
+            self._forget_segment(segment_path)
+            return
+        self.ingest_function(records, segment_id)
+        self._forget_segment(segment_path)
+        try:
+            os.remove(segment_path)
+        except FileNotFoundError:
+            pass
+
+    def _forget_segment(self, segment_path):
+        with self._lock:
+            self._segment_keys.pop(segment_path, None)
+
+    def _claim_orphaned_journal(self, journal_path):
+        if fcntl is None:
+            return None
+        try:
+            # Never creates the file, which its owner may have just rotated
+            fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            return None
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Still owned by a live process
+                return None
+            try:
+                if not os.path.samestat(os.fstat(fd), os.stat(journal_path)):
+                    # Rotated by its owner after we opened it
+                    return None
+            except FileNotFoundError:
+                return None
+            # A new name, so the owner's own segment can never be overwritten
+            segment_path = journal_path[:-len(JOURNAL_SUFFIX)] + f"-claimed-{uuid.uuid4().hex}{SEGMENT_SUFFIX}"
+            try:
+                os.rename(journal_path, segment_path)
+            except FileNotFoundError:
+                return None
+            return segment_path
+        finally:
+            os.close(fd)
+
+    def recover(self):
+        """ Ingests any segments and journals left behind by crashed processes.
+        """
+        with self._flush_lock:
+            for name in sorted(os.listdir(self.directory)):
+                path = self._path(name)
+                if name.endswith(JOURNAL_SUFFIX) and path != self._live_path:
+                    path = self._claim_orphaned_journal(path)
+                elif not name.endswith(SEGMENT_SUFFIX):
+                    continue
+                if path is None:
+                    continue
+                try:
+                    self._ingest_segment(path)
+                except Exception:
+                    print(f"Failed to recover journal segment {path}")
+                    traceback.print_exc()
+
+    def _run(self):
+        last_recovery = time.time()
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._closed:
+                break
+            try:
+                self.flush()
+                # Retry segments that failed to ingest, and those from crashed processes
+                if time.time() - last_recovery > self.recover_interval:
+                    last_recovery = time.time()
+                    self.recover()
+            except Exception:
+                print("Failed to flush event journal")
+                traceback.print_exc()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        with self._lock:
+            self._live_file.close()
+            if self.pending == 0:
+                os.remove(self._live_path)
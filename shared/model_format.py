@@ -0,0 +1,402 @@
+""" A compact, versioned format for the models stored in the Models table, used
+instead of pickle for the pipelines that SimpleAIFBuilder creates.
+
+A serialized model is laid out as:
+    MAGIC | format version (uint32) | metadata length (uint32) | JSON metadata | arrays
+The metadata describes each pipeline step, and refers to numeric arrays stored
+(8-byte aligned) in the buffer that follows it, so loading them doesn't copy
+them. The vectorizer's vocabulary is stored as a single string table, counts
+as unsigned integers, other values as float32, and XGBoost boosters in their
+native binary format.
+
+Usage (from the repository root), to convert the pickled models in a database:
+    python -m shared.model_format convert server/data/Logging.db
+"""
+
+import json
+import pickle
+import sqlite3
+import struct
+import argparse
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.pipeline import Pipeline
+from imblearn.pipeline import Pipeline as IMBPipeline
+from imblearn.over_sampling import RandomOverSampler
+from xgboost import XGBClassifier, Booster
+
+from shared.progress import ProgressEstimator, ProgressPipeline
+from shared.python_preprocesser import PythonPreprocessor
+from shared.sql_preprocessor import SQLPreprocessor
+
+MAGIC = b'AIFMODEL'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<II')
+ALIGNMENT = 8
+
+PIPELINE_TYPES = {
+    'Pipeline': Pipeline,
+    'ProgressPipeline': ProgressPipeline,
+    'IMBPipeline': IMBPipeline,
+}
+
+PREPROCESSOR_TYPES = {
+    'PythonPreprocessor': PythonPreprocessor,
+    'SQLPreprocessor': SQLPreprocessor,
+}
+
+VECTORIZER_PARAMS = [
+    'analyzer', 'binary', 'decode_error', 'encoding', 'input', 'lowercase', 'max_df',
+    'max_features', 'min_df', 'ngram_range', 'stop_words', 'strip_accents', 'token_pattern',
+]
+
+class UnsupportedModelError(ValueError):
+    """ Raised when a model can't be stored in the compact format, in which
+    case it should be pickled instead.
+    """
+    pass
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def _pack_numbers(values):
+    # Counts are stored exactly as the smallest unsigned integers that fit,
+    # and anything else as float32
+    values = np.asarray(values)
+    if values.dtype == bool:
+        return values.astype(np.uint8)
+    if values.size == 0:
+        return values.astype(np.uint32)
+    if values.min() >= 0 and np.array_equal(values, np.floor(values)):
+        for dtype in [np.uint8, np.uint16, np.uint32]:
+            if values.max() <= np.iinfo(dtype).max:
+                return values.astype(dtype)
+    return values.astype(np.float32)
+
+def _check_json(value, description):
+    try:
+        json.dumps(value)
+    except TypeError:
+        raise UnsupportedModelError(f"{description} can't be stored as JSON")
+    return value
+
+
+class _Writer:
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def add(self, array):
+        array = np.ascontiguousarray(array)
+        offset = _align(self.size)
+        if offset > self.size:
+            self.chunks.append(b'\0' * (offset - self.size))
+        data = array.tobytes()
+        self.chunks.append(data)
+        self.size = offset + len(data)
+        return {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+
+    def add_strings(self, strings):
+        # One UTF-8 buffer, which can be split on a separator that none of the
+        # strings contain, or otherwise with the (character) offset of each string
+        for separator in ['\n', '\0']:
+            if not any(separator in string for string in strings):
+                text = separator.join(strings)
+                return {
+                    'text': self.add(np.frombuffer(text.encode('utf-8', 'surrogatepass'), dtype=np.uint8)),
+                    'separator': separator,
+                    'count': len(strings),
+                }
+        text = ''.join(strings)
+        offsets = np.zeros(len(strings) + 1, dtype=np.uint64)
+        np.cumsum([len(string) for string in strings], out=offsets[1:])
+        return {
+            'text': self.add(np.frombuffer(text.encode('utf-8', 'surrogatepass'), dtype=np.uint8)),
+            'offsets': self.add(offsets),
+        }
+
+    def add_csr(self, matrix):
+        return {
+            'shape': list(matrix.shape),
+            'data': self.add(_pack_numbers(matrix.data)),
+            'indices': self.add(matrix.indices.astype(np.uint32)),
+            'indptr': self.add(matrix.indptr.astype(np.uint64)),
+        }
+
+    def to_bytes(self, metadata):
+        metadata_bytes = json.dumps(metadata).encode('utf-8')
+        header = MAGIC + HEADER.pack(FORMAT_VERSION, len(metadata_bytes)) + metadata_bytes
+        padding = b'\0' * (_align(len(header)) - len(header))
+        return b''.join([header, padding] + self.chunks)
+
+
+class _Reader:
+
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.offset = offset
+
+    def array(self, ref):
+        dtype = np.dtype(ref['dtype'])
+        count = int(np.prod(ref['shape'], dtype=np.int64))
+        # A read-only view of the buffer, rather than a copy
+        array = np.frombuffer(self.buffer, dtype=dtype, count=count, offset=self.offset + ref['offset'])
+        return array.reshape(ref['shape'])
+
+    def strings(self, ref):
+        text = self.array(ref['text']).tobytes().decode('utf-8', 'surrogatepass')
+        if 'separator' in ref:
+            return text.split(ref['separator']) if ref['count'] > 0 else []
+        offsets = self.array(ref['offsets']).tolist()
+        return [text[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+    def csr(self, ref):
+        return csr_matrix(
+            (self.array(ref['data']).astype(np.float64), self.array(ref['indices']), self.array(ref['indptr']).astype(np.int64)),
+            shape=tuple(ref['shape'])
+        )
+
+
+def _dump_vectorizer(writer, vectorizer):
+    params = vectorizer.get_params()
+    if params['tokenizer'] is not None or params['preprocessor'] is not None or params['vocabulary'] is not None:
+        raise UnsupportedModelError("Vectorizers with custom tokenizers, preprocessors or vocabularies aren't supported")
+    if np.dtype(params['dtype']) != np.int64:
+        raise UnsupportedModelError(f"Unsupported vectorizer dtype {params['dtype']}")
+    if not isinstance(params['analyzer'], str):
+        raise UnsupportedModelError("Vectorizers with custom analyzers aren't supported")
+    # Feature names, in the order of their indices
+    names = [None] * len(vectorizer.vocabulary_)
+    for name, index in vectorizer.vocabulary_.items():
+        names[index] = name
+    return {
+        'type': 'CountVectorizer',
+        'params': _check_json({param: params[param] for param in VECTORIZER_PARAMS}, "Vectorizer parameters"),
+        'vocabulary': writer.add_strings(names),
+    }
+
+def _load_vectorizer(reader, step):
+    params = dict(step['params'])
+    params['ngram_range'] = tuple(params['ngram_range'])
+    vectorizer = CountVectorizer(**params)
+    names = reader.strings(step['vocabulary'])
+    vectorizer.vocabulary_ = dict(zip(names, range(len(names))))
+    vectorizer.fixed_vocabulary_ = False
+    vectorizer.stop_words_ = set()
+    return vectorizer
+
+def _dump_progress_estimator(writer, estimator, steps):
+    vectorizer = None
+    if estimator.vectorizer is not None:
+        # The estimator shares the pipeline's vectorizer
+        matching_steps = [i for i, (_, step) in enumerate(steps) if step is estimator.vectorizer]
+        if len(matching_steps) == 0:
+            raise UnsupportedModelError("The progress estimator's vectorizer must be a step of its pipeline")
+        vectorizer = matching_steps[0]
+    subgoal_names = list(estimator.subgoal_features.keys())
+    state = {
+        'starter_code_means': writer.add(_pack_numbers(estimator.starter_code_means)),
+        'min_score': float(estimator.min_score),
+        'max_score': float(estimator.max_score),
+        'n_features': len(estimator.mean_features),
+        'subgoal_names': subgoal_names,
+        'subgoal_features': [
+            writer.add(np.flatnonzero(estimator.subgoal_features[name]).astype(np.uint32))
+            for name in subgoal_names
+        ],
+    }
+    if hasattr(estimator, 'feature_sums'):
+        # The feature means and useful features are recomputed exactly from these totals
+        state['n_samples_seen'] = int(estimator.n_samples_seen)
+        state['feature_presence_counts'] = writer.add(_pack_numbers(estimator.feature_presence_counts))
+        state['feature_sums'] = writer.add(_pack_numbers(estimator.feature_sums))
+        state['score_sample'] = writer.add_csr(estimator.score_sample)
+        state['score_sample_rng'] = _check_json(estimator._score_sample_rng.bit_generator.state, "Random state")
+    elif getattr(estimator, 'is_compact', False):
+        # Compacted models only have useful features, so their means are kept exactly
+        state['is_compact'] = True
+        state['mean_features'] = writer.add(np.asarray(estimator.mean_features, dtype=np.float64))
+        state['useful_feature_indices'] = writer.add(_pack_numbers(estimator.useful_feature_indices))
+    else:
+        # Fit by an older version, without the totals
+        state['mean_features'] = writer.add(_pack_numbers(estimator.mean_features))
+        state['useful_feature_indices'] = writer.add(_pack_numbers(estimator.useful_feature_indices))
+    return {
+        'type': 'ProgressEstimator',
+        'params': _check_json({
+            'min_feature_proportion': estimator.min_feature_proportion,
+            'max_score_percentile': estimator.max_score_percentile,
+            'starter_code': estimator.starter_code,
+            'subgoal_data': estimator.subgoal_data,
+            'score_sample_size': getattr(estimator, 'score_sample_size', 500),
+        }, "Progress estimator parameters"),
+        'vectorizer': vectorizer,
+        'state': state,
+    }
+
+def _load_progress_estimator(reader, step, steps):
+    vectorizer = steps[step['vectorizer']][1] if step['vectorizer'] is not None else None
+    estimator = ProgressEstimator(vectorizer=vectorizer, **step['params'])
+    state = step['state']
+    n_features = state['n_features']
+    estimator.starter_code_means = reader.array(state['starter_code_means']).astype(np.float64)
+    estimator.min_score = state['min_score']
+    estimator.max_score = state['max_score']
+    for name, ref in zip(state['subgoal_names'], state['subgoal_features']):
+        features = np.zeros(n_features, dtype=bool)
+        features[reader.array(ref)] = True
+        estimator.subgoal_features[name] = features
+    if 'feature_sums' in state:
+        estimator.n_samples_seen = state['n_samples_seen']
+        estimator.feature_presence_counts = reader.array(state['feature_presence_counts']).astype(np.int64)
+        estimator.feature_sums = reader.array(state['feature_sums']).astype(np.float64)
+        estimator._update_features()
+        estimator.score_sample = reader.csr(state['score_sample'])
+        estimator._score_sample_rng = np.random.default_rng()
+        estimator._score_sample_rng.bit_generator.state = state['score_sample_rng']
+    else:
+        # Not copied if already float64 (e.g. compacted models), since these models can't be updated
+        estimator.mean_features = reader.array(state['mean_features']).astype(np.float64, copy=False)
+        estimator.useful_feature_indices = reader.array(state['useful_feature_indices']).astype(bool)
+        if state.get('is_compact', False):
+            estimator.is_compact = True
+    estimator._compute_scoring_arrays()
+    return estimator
+
+def _dump_classifier(writer, classifier):
+    booster = classifier.get_booster()
+    return {
+        'type': 'XGBClassifier',
+        'params': _check_json(classifier.get_params(), "Classifier parameters"),
+        'classes': _check_json(classifier.classes_.tolist(), "Classifier classes"),
+        'n_classes': int(classifier.n_classes_),
+        'booster': writer.add(np.frombuffer(bytes(booster.save_raw(raw_format='ubj')), dtype=np.uint8)),
+    }
+
+def _load_classifier(reader, step):
+    classifier = XGBClassifier(**step['params'])
+    classifier._Booster = Booster(model_file=bytearray(reader.array(step['booster']).tobytes()))
+    classifier.classes_ = np.array(step['classes'])
+    classifier.n_classes_ = step['n_classes']
+    return classifier
+
+def _dump_step(writer, step, steps):
+    step_type = type(step).__name__
+    if type(step) in PREPROCESSOR_TYPES.values():
+        return {'type': step_type}
+    if type(step) is CountVectorizer:
+        return _dump_vectorizer(writer, step)
+    if type(step) is ProgressEstimator:
+        return _dump_progress_estimator(writer, step, steps)
+    if type(step) is RandomOverSampler:
+        # Only used while fitting, so there's no fitted state to store
+        return {'type': step_type, 'params': _check_json(step.get_params(), "Sampler parameters")}
+    if type(step) is XGBClassifier:
+        return _dump_classifier(writer, step)
+    raise UnsupportedModelError(f"Unsupported pipeline step {step_type}")
+
+def _load_step(reader, step, steps):
+    step_type = step['type']
+    if step_type in PREPROCESSOR_TYPES:
+        return PREPROCESSOR_TYPES[step_type]()
+    if step_type == 'CountVectorizer':
+        return _load_vectorizer(reader, step)
+    if step_type == 'ProgressEstimator':
+        return _load_progress_estimator(reader, step, steps)
+    if step_type == 'RandomOverSampler':
+        return RandomOverSampler(**step['params'])
+    if step_type == 'XGBClassifier':
+        return _load_classifier(reader, step)
+    raise ValueError(f"Unknown pipeline step {step_type}")
+
+def dumps(model):
+    """ Returns the model in the compact format, or raises an UnsupportedModelError.
+    """
+    pipeline_types = [name for name, pipeline_type in PIPELINE_TYPES.items() if type(model) is pipeline_type]
+    if len(pipeline_types) == 0:
+        raise UnsupportedModelError(f"Unsupported model {type(model).__name__}")
+    if model.memory is not None:
+        raise UnsupportedModelError("Pipelines with memory aren't supported")
+    writer = _Writer()
+    steps = []
+    for name, step in model.steps:
+        steps.append(dict(_dump_step(writer, step, model.steps), name=name))
+    metadata = {
+        'type': pipeline_types[0],
+        'verbose': model.verbose,
+        'steps': steps,
+    }
+    return writer.to_bytes(metadata)
+
+def is_compact(blob):
+    return blob is not None and bytes(blob[:len(MAGIC)]) == MAGIC
+
+def loads(blob):
+    """ Loads a model from the compact format. Its arrays are read-only views
+    of the blob.
+    """
+    if not is_compact(blob):
+        raise ValueError("Not a compact model")
+    version, metadata_length = HEADER.unpack_from(blob, len(MAGIC))
+    if version > FORMAT_VERSION:
+        raise ValueError(f"Unsupported model format version {version}; please update SimpleAIF")
+    metadata_start = len(MAGIC) + HEADER.size
+    metadata = json.loads(bytes(blob[metadata_start:metadata_start + metadata_length]).decode('utf-8'))
+    reader = _Reader(blob, _align(metadata_start + metadata_length))
+    steps = []
+    for step in metadata['steps']:
+        steps.append((step['name'], _load_step(reader, step, steps)))
+    return PIPELINE_TYPES[metadata['type']](steps, verbose=metadata['verbose'])
+
+def dumps_or_pickle(model):
+    try:
+        return dumps(model)
+    except UnsupportedModelError:
+        return pickle.dumps(model)
+
+def loads_or_unpickle(blob):
+    if is_compact(blob):
+        return loads(blob)
+    return pickle.loads(blob)
+
+
+def convert_database(db_path, models_table='Models'):
+    """ Rewrites the pickled models in a database in the compact format, where possible.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(f"SELECT ProblemID FROM {models_table}").fetchall()
+        for (problem_id,) in rows:
+            with conn:
+                blobs = conn.execute(f"SELECT ProgressModel, ClassifierModel FROM {models_table} WHERE ProblemID = ?", (problem_id,)).fetchone()
+                converted = []
+                for blob in blobs:
+                    if blob is None or is_compact(blob):
+                        converted.append(blob)
+                        continue
+                    converted.append(dumps_or_pickle(pickle.loads(blob)))
+                old_size = sum(len(blob or b'') for blob in blobs)
+                new_size = sum(len(blob or b'') for blob in converted)
+                # The models are unchanged, so the version isn't bumped
+                conn.execute(
+                    f"UPDATE {models_table} SET ProgressModel = ?, ClassifierModel = ? WHERE ProblemID = ?",
+                    (converted[0], converted[1], problem_id)
+                )
+                print(f"{problem_id}: {old_size} -> {new_size} bytes")
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser("convert", help="convert the pickled models in a database")
+    convert_parser.add_argument("database", help="path to the .db file")
+    args = parser.parse_args()
+    if args.command == "convert":
+        convert_database(args.database)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import os
+import mmap
+import struct
+import tempfile
+from urllib.parse import quote
+
+from shared import model_format
+
+STORE_MAGIC = b'AIFSTORE'
+# The models' version, then the length of each blob, or -1 if there is none
+STORE_HEADER = struct.Struct('<qqq')
+STORE_SUFFIX = '.models'
+ALIGNMENT = 8
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+class SharedModelStore:
+    """ A directory with one file for each problem's serialized models, stamped
+    with the models' version (from the Models table), which server processes
+    memory-map read-only instead of reading the models from the database.
+
+    Files are replaced atomically whenever the models are stored, so all the
+    processes on a machine share a single copy of each file in the OS's page
+    cache. Models in the compact format (see model_format) are loaded as views
+    of the mapped file, so their arrays aren't copied into each process.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.loads = 0
+        self.publishes = 0
+
+    def path_for(self, problem_id):
+        return os.path.join(self.directory, quote(str(problem_id), safe='') + STORE_SUFFIX)
+
+    def get_version(self, problem_id):
+        """ Returns the version of the problem's published models, or None if
+        there are none.
+        """
+        try:
+            with open(self.path_for(problem_id), 'rb') as file:
+                header = file.read(len(STORE_MAGIC) + STORE_HEADER.size)
+        except FileNotFoundError:
+            return None
+        if len(header) < len(STORE_MAGIC) + STORE_HEADER.size or not header.startswith(STORE_MAGIC):
+            return None
+        return STORE_HEADER.unpack_from(header, len(STORE_MAGIC))[0]
+
+    def publish(self, problem_id, version, progress_blob, classifier_blob):
+        """ Writes the problem's serialized models, replacing any that are
+        already published.
+        """
+        blobs = [progress_blob, classifier_blob]
+        parts = [STORE_MAGIC, STORE_HEADER.pack(version, *[len(blob) if blob is not None else -1 for blob in blobs])]
+        offset = len(STORE_MAGIC) + STORE_HEADER.size
+        for blob in blobs:
+            if blob is None:
+                continue
+            # Blobs are aligned, so the arrays in compact models stay aligned
+            padding = _align(offset) - offset
+            parts.append(b'\0' * padding)
+            parts.append(bytes(blob))
+            offset += padding + len(blob)
+        path = self.path_for(problem_id)
+        # Written to a temporary file and renamed, so readers never see partial models
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(b''.join(parts))
+            os.replace(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+        self.publishes += 1
+
+    def load(self, problem_id, version):
+        """ Returns the problem's models and their size in bytes, or (None, 0) if
+        the published models aren't the given version.
+        """
+        try:
+            with open(self.path_for(problem_id), 'rb') as file:
+                # The mapping stays valid after the file is closed, or replaced
+                buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # ValueError is raised for empty files
+            return None, 0
+        offset = len(STORE_MAGIC) + STORE_HEADER.size
+        if len(buffer) < offset or buffer[:len(STORE_MAGIC)] != STORE_MAGIC:
+            buffer.close()
+            return None, 0
+        published_version, *lengths = STORE_HEADER.unpack_from(buffer, len(STORE_MAGIC))
+        if published_version != version:
+            buffer.close()
+            return None, 0
+        view = memoryview(buffer)
+        models = []
+        for length in lengths:
+            if length < 0:
+                models.append(None)
+                continue
+            offset = _align(offset)
+            models.append(model_format.loads_or_unpickle(view[offset:offset + length]))
+            offset += length
+        self.loads += 1
+        return tuple(models), sum(max(length, 0) for length in lengths)
+
+    def stats(self):
+        return {
+            "loads": self.loads,
+            "publishes": self.publishes,
+        }
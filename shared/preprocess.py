@@ -13,25 +13,83 @@ from imblearn.pipeline import Pipeline as IMBPipeline
 from imblearn.over_sampling import RandomOverSampler
 
 from shared.progsnap import ProgSnap2Dataset, PS2, EventType
-from shared.progress import ProgressEstimator
+from shared.progress import ProgressEstimator, ProgressPipeline
+from shared.snapshot import TrainingSnapshot
 from shared.python_preprocesser import PythonPreprocessor
 from shared.sql_preprocessor import SQLPreprocessor
 
 LANG_PYTHON = "python"
 LANG_SQL = "sql"
 
+# Event types whose code is used for training
+SUBMIT_EVENT_TYPES = [EventType.Submit, EventType.RunProgram, 'Project.Submit']
+
+class PreparedDataset:
+    """ A dataset's scored submissions, which are filtered by event type, joined
+    with their code and grouped by problem once, so that the builders of many
+    problems can share them (see SimpleAIFBuilder.build). Each problem's
+    submissions are a contiguous slice of one table, and are returned without
+    copying them.
+    """
+
+    def __init__(self, data: ProgSnap2Dataset, submit_columns=SUBMIT_EVENT_TYPES,
+                 problem_id_column=PS2.ProblemID, code_column=PS2.Code):
+        self.submit_columns = list(submit_columns)
+        self.problem_id_column = problem_id_column
+        self.code_column = code_column
+
+        submissions = data.get_submissions(
+            None, self.submit_columns, scored_only=True,
+            problem_id_column=problem_id_column, code_column=code_column
+        )
+        self.mean_scores = submissions.groupby(problem_id_column)[PS2.Score].mean()
+        submissions = submissions[~submissions[code_column].isna()]
+        # A stable sort keeps each problem's submissions in their original order
+        self.submissions = submissions.sort_values(problem_id_column, kind="stable").reset_index(drop=True)
+        counts = self.submissions.groupby(problem_id_column, sort=False).size()
+        stops = counts.cumsum()
+        self._ranges = {
+            problem_id: (stop - count, stop)
+            for problem_id, count, stop in zip(counts.index, counts.to_numpy(), stops.to_numpy())
+        }
+
+        self._assignment_rows = {}
+        assignment_table = data.load_link_table(problem_id_column.replace("ID", ""))
+        if assignment_table is not None:
+            for _, row in assignment_table.iterrows():
+                # Like SimpleAIFBuilder, the first matching row is used
+                self._assignment_rows.setdefault(row[problem_id_column], row)
+
+    def get_problem_ids(self):
+        return list(self._ranges.keys())
+
+    def get_submissions(self, problem_id):
+        start, stop = self._ranges.get(problem_id, (0, 0))
+        return self.submissions.iloc[start:stop]
+
+    def get_assignment_row(self, problem_id):
+        return self._assignment_rows.get(problem_id)
+
 class SimpleAIFBuilder:
     def __init__(self, problem_id, code_column=PS2.Code, problem_id_column=PS2.ProblemID):
         self.problem_id = problem_id
         self.code_column = code_column
         self.problem_id_column = problem_id_column
 
-        self.submit_columns = [EventType.Submit, EventType.RunProgram, 'Project.Submit']
+        self.submit_columns = list(SUBMIT_EVENT_TYPES)
         self.ngram_range = (1,3)
         self.classifier_factory = lambda: XGBClassifier()
         self.subgoal_json = None
         self.subgoal_data = None
         self.lang = None
+        self.ps2_dataset = None
+        self.prepared_dataset = None
+        self._mean_scores = None
+        # This problem's row of the assignment link table, read once per build
+        self.assignment_row = None
+        # If set, training submissions are cached in this directory, so that
+        # rebuilds only need to read new events
+        self.snapshot_directory = None
         self.token_pattern = r"[\w]+|[^\s]|[ ]{4}"
 
     def create_vectorizer(self):
@@ -61,6 +119,9 @@ class SimpleAIFBuilder:
         return IMBPipeline(stages)
 
     def _get_assignment_row(self):
+        return self.assignment_row
+
+    def _load_assignment_row(self):
         assignment_table = self.ps2_dataset.load_link_table(self.problem_id_column.replace("ID", ""))
         if assignment_table is None:
             return None
@@ -100,10 +161,10 @@ class SimpleAIFBuilder:
         if preprocessor is not None:
             stages.insert(0, ("preprocessor", preprocessor))
 
-        return Pipeline(stages)
+        return ProgressPipeline(stages)
 
     @staticmethod
-    def get_submissions_table(data, submit_columns = [EventType.Submit, EventType.RunProgram, 'Project.Submit']):
+    def get_submissions_table(data, submit_columns = SUBMIT_EVENT_TYPES):
         main_table = data.get_main_table()
         submissions = main_table[main_table[PS2.EventType].isin(submit_columns)]
         return submissions
@@ -118,23 +179,99 @@ class SimpleAIFBuilder:
         # For both  models, we only want code with a specific score
         return merged[~merged[PS2.Score].isna()]
 
+    @property
+    def mean_scores(self):
+        # Needs every problem's submissions, so only loaded if used
+        if self.prepared_dataset is not None:
+            return self.prepared_dataset.mean_scores
+        if self._mean_scores is None:
+            submissions = SimpleAIFBuilder.get_submissions_table(self.ps2_dataset, self.submit_columns)
+            self._mean_scores = submissions.groupby(self.problem_id_column).Score.mean()
+        return self._mean_scores
+
     def build(self, data: ProgSnap2Dataset):
+        if isinstance(data, PreparedDataset):
+            return self.build_prepared(data)
         self.ps2_dataset = data
-        submissions = SimpleAIFBuilder.get_submissions_table(data, self.submit_columns)
-        self.mean_scores = submissions.groupby(self.problem_id_column).Score.mean()
-        assignment_submissions = submissions[submissions[self.problem_id_column] == self.problem_id]
-        assignment_code = SimpleAIFBuilder.get_code_table(data, assignment_submissions, self.problem_id_column, self.code_column)
+        self.prepared_dataset = None
+        self._mean_scores = None
+        self.assignment_row = self._load_assignment_row()
+        if self.snapshot_directory is not None:
+            assignment_code = self._get_snapshot_submissions(data)
+        else:
+            # Only this problem's scored submissions (and their code) are loaded
+            assignment_code = data.get_submissions(
+                self.problem_id, self.submit_columns, scored_only=True,
+                problem_id_column=self.problem_id_column, code_column=self.code_column
+            )
+        self._set_training_data(assignment_code)
+        self.build_subgoals()
 
-        df = assignment_code.copy()
-        # print(f"Found {len(df)} submissions for {self.problem_id}")
-        df["Code"] = df[self.code_column]
-        df["Correct"] = df["Score"] >= 1
-        df = df[~df["Code"].isna()]
+    def build_prepared(self, prepared):
+        """ Builds from a PreparedDataset, which can be shared by the builders of
+        many problems.
+        """
+        if (prepared.submit_columns != list(self.submit_columns) or prepared.code_column != self.code_column
+                or prepared.problem_id_column != self.problem_id_column):
+            raise ValueError("The dataset was prepared with different columns than this builder uses")
+        self.ps2_dataset = None
+        self.prepared_dataset = prepared
+        self._mean_scores = None
+        self.assignment_row = prepared.get_assignment_row(self.problem_id)
+        self._set_training_data(prepared.get_submissions(self.problem_id))
+        self.build_subgoals()
 
-        self.X_train = df["Code"]
-        self.y_train = df["Correct"]
+    def _set_training_data(self, assignment_code):
+        # print(f"Found {len(assignment_code)} submissions for {self.problem_id}")
+        # The submissions may be a slice of a PreparedDataset, so they aren't copied
+        codes = assignment_code[self.code_column]
+        scores = assignment_code[PS2.Score]
+        has_code = ~codes.isna()
+        if not has_code.all():
+            codes, scores = codes[has_code], scores[has_code]
+
+        self.X_train = codes
+        self.y_train = scores >= 1
+
+    def _get_snapshot_submissions(self, data: ProgSnap2Dataset):
+        query = {
+            "problem_id": str(self.problem_id),
+            "event_types": list(self.submit_columns),
+            "problem_id_column": self.problem_id_column,
+            "code_column": self.code_column,
+        }
+        max_event_ids = data.get_max_event_ids()
+        if max_event_ids is None:
+            # The data can't be read incrementally, so just read all of it
+            return data.get_submissions(
+                self.problem_id, self.submit_columns, scored_only=True,
+                problem_id_column=self.problem_id_column, code_column=self.code_column
+            )
+        path = TrainingSnapshot.path_for(self.snapshot_directory, self.problem_id)
+        snapshot = TrainingSnapshot.load(path)
+        if snapshot is None or not snapshot.is_valid_for(query, max_event_ids):
+            snapshot = TrainingSnapshot(query)
+
+        # Events logged while reading are left for the next rebuild
+        new_submissions = data.get_submissions(
+            self.problem_id, self.submit_columns, scored_only=True,
+            problem_id_column=self.problem_id_column, code_column=self.code_column,
+            since_event_ids=snapshot.watermark, until_event_ids=max_event_ids
+        )
 
-        self.build_subgoals()
+        codes = new_submissions[self.code_column]
+        new_submissions = new_submissions[~codes.isna()]
+        # Everything up to the current max EventIDs has been read, even if it didn't match
+        snapshot.append(
+            new_submissions[self.code_column].tolist(),
+            new_submissions[PS2.Score].to_numpy(),
+            [int(event_id) for event_id in max_event_ids]
+        )
+        snapshot.save(path)
+        return pd.DataFrame({
+            PS2.Score: snapshot.scores,
+            self.code_column: pd.Series(snapshot.codes, dtype=object),
+        })
 
     def build_subgoals(self):
         assignment_row = self._get_assignment_row()
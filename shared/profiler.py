@@ -0,0 +1,186 @@
+import os
+import re
+import sys
+import hashlib
+import time
+import atexit
+import threading
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+
+PROFILE_SUFFIX = '.collapsed'
+# Key parts (e.g. client-supplied ProblemIDs) are truncated to this length in file names
+MAX_NAME_PART = 40
+ROOT_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+class StackProfiler:
+    """ A sampling profiler for selected pieces of work (e.g. requests or model
+    builds), each of which is labelled with a key, such as (route, ProblemID).
+
+    While any work is being profiled, a single background thread records the
+    Python stack of each thread doing profiled work every interval seconds
+    (including time spent waiting, e.g. for locks, and in C code, which is
+    attributed to the Python function that called it). Stacks are counted per
+    key, and every flush_interval seconds written to the directory in the
+    collapsed format read by flamegraph.pl and speedscope, with one file per
+    key. Only the newest max_files files are kept.
+    """
+
+    def __init__(self, directory, interval=0.005, flush_interval=60, max_files=500):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.max_files = max_files
+        self.profiled = 0
+        self.samples = 0
+        self.files_written = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        # The key of the work that each profiled thread is doing, by thread ID
+        self._active = {}
+        self._stacks = {}
+        self._frame_names = {}
+        self._last_flush = time.time()
+        self._thread = None
+        atexit.register(self.flush)
+
+    def start(self, *key):
+        """ Starts profiling the calling thread's work under the given key, and
+        returns a token to pass to stop. Nested work is counted under the
+        innermost key.
+        """
+        thread_id = threading.get_ident()
+        with self._lock:
+            previous = self._active.get(thread_id)
+            self._active[thread_id] = key
+            self.profiled += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="aif-profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return previous
+
+    def stop(self, token):
+        thread_id = threading.get_ident()
+        with self._lock:
+            if token is None:
+                self._active.pop(thread_id, None)
+            else:
+                self._active[thread_id] = token
+
+    @contextmanager
+    def profile(self, *key):
+        token = self.start(*key)
+        try:
+            yield
+        finally:
+            self.stop(token)
+
+    def _frame_name(self, code):
+        name = self._frame_names.get(code)
+        if name is None:
+            filename = code.co_filename
+            if filename.startswith(ROOT_DIRECTORY + os.sep):
+                filename = os.path.relpath(filename, ROOT_DIRECTORY)
+            elif 'site-packages' + os.sep in filename:
+                filename = filename.split('site-packages' + os.sep, 1)[1]
+            # Semicolons separate frames in the collapsed format
+            name = f"{code.co_name} ({filename})".replace(';', ':')
+            self._frame_names[code] = name
+        return name
+
+    def _sample(self):
+        with self._lock:
+            active = dict(self._active)
+        if len(active) == 0:
+            return
+        frames = sys._current_frames()
+        for thread_id, key in active.items():
+            frame = frames.get(thread_id)
+            names = []
+            while frame is not None:
+                names.append(self._frame_name(frame.f_code))
+                frame = frame.f_back
+            if len(names) == 0:
+                continue
+            stack = ';'.join(reversed(names))
+            with self._lock:
+                self._stacks.setdefault(key, Counter())[stack] += 1
+                self.samples += 1
+
+    def _run(self):
+        while True:
+            try:
+                # Cleared before checking, so a start() after the check still wakes us
+                self._wake.clear()
+                with self._lock:
+                    idle = len(self._active) == 0
+                if idle:
+                    # Nothing is being profiled, so wait until something is
+                    self._wake.wait(self.flush_interval)
+                else:
+                    self._sample()
+                    time.sleep(self.interval)
+                if time.time() - self._last_flush >= self.flush_interval:
+                    self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    @staticmethod
+    def _name_part(part):
+        text = str(part).strip('/') or 'root'
+        name = re.sub(r'[^A-Za-z0-9._]', '_', text)[:MAX_NAME_PART]
+        if name != text:
+            # Keeps parts that were changed or truncated distinct
+            name += '_' + hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()[:8]
+        return name
+
+    def _path_for(self, timestamp, key):
+        name = '-'.join(self._name_part(part) for part in key)
+        return os.path.join(self.directory, f"{timestamp}-{os.getpid()}-{name}{PROFILE_SUFFIX}")
+
+    def flush(self):
+        """ Writes the stacks sampled since the last flush, then removes the
+        oldest files beyond max_files.
+        """
+        with self._lock:
+            stacks = self._stacks
+            self._stacks = {}
+            self._last_flush = time.time()
+        if len(stacks) == 0:
+            return
+        timestamp = time.strftime('%Y%m%d-%H%M%S')
+        for key, counts in stacks.items():
+            # Each key is written separately, so one failure doesn't lose the others
+            try:
+                with open(self._path_for(timestamp, key), 'a') as file:
+                    for stack, count in counts.most_common():
+                        file.write(f"{stack} {count}\n")
+                self.files_written += 1
+            except OSError:
+                print(f"Failed to write the profile for {key}")
+                traceback.print_exc()
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(PROFILE_SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    files.append((os.path.getmtime(path), path))
+                except FileNotFoundError:
+                    # Removed by another process
+                    pass
+        files.sort()
+        for _, path in files[:max(len(files) - self.max_files, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return {
+            "profiled": self.profiled,
+            "samples": self.samples,
+            "files_written": self.files_written,
+        }
@@ -1,7 +1,9 @@
 import numpy as np
 import pandas as pd
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, csc_matrix, issparse, vstack
 from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.pipeline import Pipeline
 from sklearn.utils.validation import check_X_y, check_array, check_is_fitted
 from sklearn.utils.multiclass import unique_labels
 from sklearn.metrics import euclidean_distances
@@ -14,61 +16,175 @@ class ProgressEstimator(BaseEstimator):
     # TODO: The problem with this approach is that if the model is rebuilt
     # the subgoals aren't stored anywhere, so they're lost
     def __init__(self, min_feature_proportion = 0.5, max_score_percentile = 0.25,
-                 starter_code = None, vectorizer = None, subgoal_data = None):
+                 starter_code = None, vectorizer = None, subgoal_data = None,
+                 score_sample_size = 500):
         self.min_feature_proportion = min_feature_proportion
         self.max_score_percentile = max_score_percentile
         self.vectorizer = vectorizer
         self.starter_code = starter_code
         self.subgoal_data = subgoal_data
+        # The number of training examples kept to estimate the max_score
+        # percentile after partial_fit
+        self.score_sample_size = score_sample_size
         self.subgoal_features = {}
 
         if starter_code is not None:
             if vectorizer is None:
                 raise ValueError("If starter_code is provided, vectorizer must also be provided")
 
-    def calculate_subgoal_features(self, subgoal_index):
-        feature_names = self.vectorizer.get_feature_names_out()
-        return np.array(subgoals.are_ngrams_relevant_for_subgoal_index(self.subgoal_data, feature_names, subgoal_index))
+    def calculate_subgoal_features(self, subgoal_index, feature_names = None):
+        if feature_names is None:
+            feature_names = self.vectorizer.get_feature_names_out()
+        return np.array(subgoals.are_ngrams_relevant_for_subgoal_index(self.subgoal_data, feature_names, subgoal_index), dtype=bool)
 
+    def _calculate_starter_code_means(self, n_columns):
+        if self.starter_code is None:
+            return np.zeros(n_columns)
+        starter_code_vector = self.vectorizer.transform([self.starter_code])
+        starter_code_vector = self.ensure_is_np_array(starter_code_vector)
+        return starter_code_vector.mean(axis=0)
 
     def fit(self, X, y = None):
 
-        if self.starter_code is not None:
-            starter_code_vector = self.vectorizer.transform([self.starter_code])
-            starter_code_vector = self.ensure_is_np_array(starter_code_vector)
-            self.starter_code_means = starter_code_vector.mean(axis=0)
+        self.starter_code_means = self._calculate_starter_code_means(X.shape[1])
+
+        # Work directly on the sparse matrix, since densifying all solutions
+        # across the n-gram vocabulary can take gigabytes for popular problems
+        X_train = self.ensure_is_csr(X)
+        n_rows, n_columns = X_train.shape
+
+        # Running totals, which partial_fit adds to
+        self.n_samples_seen = n_rows
+        present_columns = X_train.indices[X_train.data > 0]
+        self.feature_presence_counts = np.bincount(present_columns, minlength=n_columns)
+        self.feature_sums = np.bincount(X_train.indices, weights=X_train.data, minlength=n_columns)
+        self._update_features()
+
+        if self.subgoal_data is not None:
+            try:
+                header = self.subgoal_data["header"]
+                for subgoal in header:
+                    subgoal_name = subgoal["text"]
+                    subgoal_index = subgoal["subgoalIndex"]
+                    self.subgoal_features[subgoal_name] = self.calculate_subgoal_features(subgoal_index)
+                    print(f"Subgoal [{subgoal_index}] {subgoal_name} has {self.subgoal_features[subgoal_name].sum()} / {self.useful_feature_indices.sum()} features")
+            except Exception as e:
+                print("Error calculating subgoal features")
+                print(e)
+                self.subgoal_features = {}
+
+        self._compute_scoring_arrays()
+        train_scores = self._progress_score(X_train)
+        self._set_score_range(train_scores)
+
+        # A uniform sample of the training data, kept up to date by partial_fit
+        self._score_sample_rng = np.random.default_rng(0)
+        if n_rows <= self.score_sample_size:
+            self.score_sample = X_train.copy()
         else:
-            self.starter_code_means = np.zeros(X_train.shape[1])
+            rows = np.sort(self._score_sample_rng.choice(n_rows, self.score_sample_size, replace=False))
+            self.score_sample = X_train[rows]
+
+        return self
 
-        # Should be redundant with ensure below
-        # X = check_array(X)
+    def partial_fit(self, X, y = None):
+        """ Updates the model with more training examples, giving the same feature
+        means and proportions as fitting on all of them at once. The max score is
+        re-estimated from a sample of the training examples. X may have more
+        columns than the model was fit with, if the vectorizer has new features.
+        """
+        if not hasattr(self, "mean_features"):
+            return self.fit(X, y)
+        if getattr(self, "is_compact", False):
+            raise ValueError("This model has been compacted, so it must be refit to use partial_fit")
+        if not hasattr(self, "feature_sums"):
+            raise ValueError("This model was fit by an older version, so it must be refit to use partial_fit")
+        X = self.ensure_is_csr(X)
+        if X.shape[0] == 0:
+            return self
+        self._add_features(X.shape[1])
 
-        X_train = self.ensure_is_np_array(X)
+        n_columns = X.shape[1]
+        present_columns = X.indices[X.data > 0]
+        self.feature_presence_counts += np.bincount(present_columns, minlength=n_columns)
+        self.feature_sums += np.bincount(X.indices, weights=X.data, minlength=n_columns)
+        self.n_samples_seen += X.shape[0]
+        self._update_features()
+        self._compute_scoring_arrays()
 
-        perc_feat_present = (X_train > 0).mean(axis=0)
+        self._update_score_sample(X)
+        self._set_score_range(self._progress_score(self.score_sample))
+        return self
+
+    def compact(self, feature_indices):
+        """ Keeps only the given features (which must include all the useful
+        features), so the model gives the same scores for X[:, feature_indices].
+        The running totals are discarded, so partial_fit can no longer be used.
+        """
+        self.starter_code_means = self.starter_code_means[feature_indices]
+        self.mean_features = self.mean_features[feature_indices]
+        self.useful_feature_indices = self.useful_feature_indices[feature_indices]
+        for name, features in self.subgoal_features.items():
+            self.subgoal_features[name] = features[feature_indices]
+        for attribute in ["n_samples_seen", "feature_presence_counts", "feature_sums", "score_sample", "_score_sample_rng"]:
+            if hasattr(self, attribute):
+                delattr(self, attribute)
+        self.is_compact = True
+        self._compute_scoring_arrays()
+        return self
+
+    def _update_features(self):
+        perc_feat_present = self.feature_presence_counts / self.n_samples_seen
         self.useful_feature_indices = perc_feat_present > self.min_feature_proportion
         n_features = self.useful_feature_indices.mean()
 
         # Calculate the mean of each feature in the training data, but subtract the starter code
-        self.mean_features = X_train.mean(axis=0) - self.starter_code_means
+        self.mean_features = self.feature_sums / self.n_samples_seen - self.starter_code_means
         # Remove features that are equally or less common in the training data than in the starter code
         self.useful_feature_indices = self.useful_feature_indices & (self.mean_features > 0)
         # print(f"Went from {n_features} to {self.useful_feature_indices.mean()} features")
 
-        if self.subgoal_data is not None:
+    def _add_features(self, n_columns):
+        n_old_columns = len(self.feature_sums)
+        if n_columns < n_old_columns:
+            raise ValueError(f"X has {n_columns} features, but the model has {n_old_columns}")
+        if n_columns == n_old_columns:
+            return
+        # None of the training examples so far had the new features
+        n_new_columns = n_columns - n_old_columns
+        self.feature_presence_counts = np.concatenate([self.feature_presence_counts, np.zeros(n_new_columns, dtype=self.feature_presence_counts.dtype)])
+        self.feature_sums = np.concatenate([self.feature_sums, np.zeros(n_new_columns)])
+        self.starter_code_means = self._calculate_starter_code_means(n_columns)
+        sample = self.score_sample
+        self.score_sample = csr_matrix((sample.data, sample.indices, sample.indptr), shape=(sample.shape[0], n_columns))
+
+        if len(self.subgoal_features) > 0:
+            new_feature_names = self.vectorizer.get_feature_names_out()[n_old_columns:]
             try:
-                header = self.subgoal_data["header"]
-                for subgoal in header:
+                for subgoal in self.subgoal_data["header"]:
                     subgoal_name = subgoal["text"]
-                    subgoal_index = subgoal["subgoalIndex"]
-                    self.subgoal_features[subgoal_name] = self.calculate_subgoal_features(subgoal_index)
-                    print(f"Subgoal [{subgoal_index}] {subgoal_name} has {self.subgoal_features[subgoal_name].sum()} / {self.useful_feature_indices.sum()} features")
+                    new_features = self.calculate_subgoal_features(subgoal["subgoalIndex"], new_feature_names)
+                    self.subgoal_features[subgoal_name] = np.concatenate([self.subgoal_features[subgoal_name], new_features])
             except Exception as e:
                 print("Error calculating subgoal features")
                 print(e)
                 self.subgoal_features = {}
 
-        train_scores = self._progress_score(X_train)
+    def _update_score_sample(self, X):
+        # Reservoir sampling, so the sample stays uniform over all training examples
+        sample = self.score_sample
+        n_seen_before = self.n_samples_seen - X.shape[0]
+        keep = list(range(sample.shape[0]))
+        for i in range(X.shape[0]):
+            if len(keep) < self.score_sample_size:
+                keep.append(sample.shape[0] + i)
+                continue
+            j = self._score_sample_rng.integers(0, n_seen_before + i + 1)
+            if j < self.score_sample_size:
+                keep[j] = sample.shape[0] + i
+        self.score_sample = vstack([sample, X], format="csr")[keep]
+
+    def _set_score_range(self, train_scores):
         self.min_score = 0 #train_scores.min()
         self.max_score = np.percentile(train_scores, self.max_score_percentile * 100)
 
@@ -77,8 +193,6 @@ class ProgressEstimator(BaseEstimator):
             self.min_score = 0
             self.max_score = 1
 
-        return self
-
     @staticmethod
     def ensure_is_np_array(X):
         if isinstance(X, csr_matrix):
@@ -90,44 +204,143 @@ class ProgressEstimator(BaseEstimator):
         return X
 
 
-    # TODO: Could almost certainly be made more efficient
-    def _progress_score_single(self, features, useful_feature_indices, ignore_counts=False):
-        # Subtract the starting feature values and divide by the average
-        completion = (features[useful_feature_indices] - self.starter_code_means[useful_feature_indices]) / \
-            self.mean_features[useful_feature_indices]
-        if ignore_counts:
-            completion = completion > 0
-        completion = np.clip(completion, 0, 1)
-        return completion.mean()
+    @staticmethod
+    def ensure_is_csr(X):
+        if issparse(X):
+            X = X.tocsr()
+        else:
+            X = csr_matrix(ProgressEstimator.ensure_is_np_array(X))
+        # Scoring and fitting assume each feature appears at most once per row
+        if not X.has_canonical_format:
+            X = X.copy()
+            X.sum_duplicates()
+        return X
+
+    def _compute_scoring_arrays(self):
+        # Precomputed once, so scoring only needs to touch the nonzero features
+        self.feature_reciprocals = np.divide(
+            1, self.mean_features, out=np.zeros(len(self.mean_features)),
+            where=self.useful_feature_indices
+        )
+        self.n_useful_features = self.useful_feature_indices.sum()
+        # Each column of the subgoal matrix selects the useful features of one subgoal
+        self.subgoal_names = list(self.subgoal_features.keys())
+        self.subgoal_matrix = self._create_subgoal_matrix(self.subgoal_features.values())
+        self.subgoal_feature_counts = np.asarray(self.subgoal_matrix.sum(axis=0)).ravel()
+
+    def _create_subgoal_matrix(self, masks):
+        masks = [self.useful_feature_indices & mask for mask in masks]
+        if len(masks) == 0:
+            return csc_matrix((len(self.useful_feature_indices), 0))
+        return csc_matrix(np.column_stack(masks).astype(float))
+
+    @staticmethod
+    def _mean_completion(totals, n_features):
+        # Subgoals with no useful features have a NaN score
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return totals / n_features
+
+    def _progress_scores(self, X, include_subgoals = True, subgoal_matrix = None, subgoal_feature_counts = None):
+        # For each useful feature, a row's completion is its feature value minus
+        # the starter code's, divided by the mean value in correct solutions,
+        # clipped to [0, 1]. The score is the mean completion across features.
+        # A feature that is absent from a row always has completion 0 (since
+        # the starter code's value is nonnegative), so we only need to compute
+        # completions for the nonzero entries of the sparse matrix.
+        # Subgoal scores ignore counts: a feature is complete if the row has
+        # more of it than the starter code. All subgoals are scored at once,
+        # by multiplying these indicators by the subgoal matrix.
+        if not hasattr(self, "subgoal_matrix"):
+            # Models pickled by older versions won't have these arrays
+            self._compute_scoring_arrays()
+        X = self.ensure_is_csr(X)
+        n_rows = X.shape[0]
+        starter_difference = X.data - self.starter_code_means[X.indices]
+        completion = np.clip(starter_difference * self.feature_reciprocals[X.indices], 0, 1)
+        rows = np.repeat(np.arange(n_rows), np.diff(X.indptr))
+        totals = np.bincount(rows, weights=completion, minlength=n_rows)
+        scores = self._mean_completion(totals, self.n_useful_features)
+
+        if subgoal_matrix is None:
+            subgoal_matrix = self.subgoal_matrix
+            subgoal_feature_counts = self.subgoal_feature_counts
+        if not include_subgoals or subgoal_matrix.shape[1] == 0:
+            return scores, np.zeros((n_rows, 0))
+        present = csr_matrix(((starter_difference > 0).astype(float), X.indices, X.indptr), shape=X.shape)
+        subgoal_totals = (present @ subgoal_matrix).toarray()
+        return scores, self._mean_completion(subgoal_totals, subgoal_feature_counts)
 
     def _progress_score(self, X, mask = None):
-        useful_feature_indices = self.useful_feature_indices
-        ignore_counts = mask is not None
-        if mask is not None:
-            useful_feature_indices = useful_feature_indices & mask
-        return np.apply_along_axis(
-            lambda x: self._progress_score_single(
-                x, useful_feature_indices, ignore_counts
-            ), 1, X)
+        if mask is None:
+            return self._progress_scores(X, include_subgoals=False)[0]
+        subgoal_matrix = self._create_subgoal_matrix([mask])
+        subgoal_feature_counts = np.asarray(subgoal_matrix.sum(axis=0)).ravel()
+        return self._progress_scores(X, True, subgoal_matrix, subgoal_feature_counts)[1][:, 0]
 
     def predict_proba(self, X, subgoal_list = None):
         # Check if fit has been called
         # Buggy for some reason...
         # check_is_fitted(self)
 
-        X = self.ensure_is_np_array(X)
+        include_subgoals = subgoal_list is not None and isinstance(subgoal_list, list)
+        scores, subgoal_scores = self._progress_scores(X, include_subgoals)
 
-        if subgoal_list is not None and isinstance(subgoal_list, list):
-            for name, mask in self.subgoal_features.items():
+        if include_subgoals:
+            for i, name in enumerate(self.subgoal_names):
                 # TODO: Scale?
                 subgoal_list.append({
                     "name": name,
-                    "score": self._progress_score(X, mask)
+                    "score": subgoal_scores[:, i]
                 })
 
-        scores = self._progress_score(X)
         scaled =  (scores - self.min_score) / (self.max_score - self.min_score)
         return scaled.clip(0, 1)
 
     def predict(self, X):
         return self.predict_proba(X) > 0.5
+
+
+class ProgressPipeline(Pipeline):
+    """ A Pipeline ending in a ProgressEstimator, which can be updated with new
+    training examples using partial_fit. Any n-grams in the new examples that
+    the vectorizer hasn't seen are added to its vocabulary.
+    """
+
+    def partial_fit(self, X, y = None):
+        Xt = X
+        for _, step in self.steps[:-1]:
+            if isinstance(step, CountVectorizer):
+                self._extend_vocabulary(step, Xt)
+            Xt = step.transform(Xt)
+        self.steps[-1][1].partial_fit(Xt, y)
+        return self
+
+    def compact(self):
+        """ Removes every feature that the progress model doesn't use from the
+        vectorizer's vocabulary, without changing any scores, so that the model
+        is smaller and faster to load and run. Compacted models can't be updated
+        with partial_fit.
+        """
+        estimator = self.steps[-1][1]
+        vectorizer = estimator.vectorizer
+        if not any(step is vectorizer for _, step in self.steps[:-1]):
+            raise ValueError("The progress model's vectorizer must be a step of the pipeline")
+        # Subgoals only score useful features, so these are the only ones needed
+        feature_indices = np.flatnonzero(estimator.useful_feature_indices)
+        if len(feature_indices) == 0:
+            # Vectorizers can't have an empty vocabulary
+            return self
+        feature_names = vectorizer.get_feature_names_out()[feature_indices]
+        vectorizer.vocabulary_ = {name: i for i, name in enumerate(feature_names)}
+        estimator.compact(feature_indices)
+        return self
+
+    @staticmethod
+    def _extend_vocabulary(vectorizer, X):
+        # New features are added at the end, so existing feature indices don't change
+        analyzer = vectorizer.build_analyzer()
+        vocabulary = vectorizer.vocabulary_
+        for document in X:
+            for feature in analyzer(document):
+                if feature not in vocabulary:
+                    vocabulary[feature] = len(vocabulary)
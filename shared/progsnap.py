@@ -90,7 +90,7 @@ class EventType:
 
 
 import pandas as pd
-from shared.database import PS2DataProvider
+from shared.database import PS2DataProvider, filter_submissions
 
 class ProgSnap2Dataset:
 
@@ -131,6 +131,31 @@ class ProgSnap2Dataset:
         """
         self.main_table = main_table.copy()
 
+    def get_submissions(self, problem_id=None, event_types=None, scored_only=False,
+                        problem_id_column=PS2.ProblemID, code_column=PS2.Code,
+                        since_event_ids=None, until_event_ids=None) -> pd.DataFrame:
+        """ Returns the EventID, problem ID, Score and code of each matching event.
+        See PS2DataProvider.get_submissions.
+        """
+        if self.main_table is None:
+            return self.data_provider.get_submissions(
+                problem_id, event_types, scored_only, problem_id_column, code_column,
+                since_event_ids, until_event_ids
+            )
+        # The main table has already been loaded (or overwritten), so filter that
+        return filter_submissions(
+            self.get_main_table(), self.get_code_states_table(), problem_id, event_types,
+            scored_only, problem_id_column, code_column, since_event_ids, until_event_ids
+        )
+
+    def get_max_event_ids(self):
+        """ Returns the largest EventIDs of the data provider (see
+        PS2DataProvider.get_max_event_ids), or None if the main table has been overwritten.
+        """
+        if self.main_table is not None:
+            return None
+        return self.data_provider.get_max_event_ids()
+
     def get_code_states_table(self):
         """ Returns a Pandas DataFrame with the code states table form this dataset
         """
@@ -1,35 +1,57 @@
 from sklearn.base import BaseEstimator, TransformerMixin
 from shared.progress import ProgressEstimator
+from shared.cache import LRUCache
 import io, tokenize
+import hashlib
 import numpy as np
 import re
 
 class PythonPreprocessor(BaseEstimator, TransformerMixin):
 
+    # first group captures quoted strings (double or single)
+    # second group captures comments (//single-line or /* multi-line */)
+    __comment_regex = re.compile(r"(\".*?(?<!\\)\"|\'.*?(?<!\\)\')|(/\*.*?\*/|//[^\r\n]*$)", re.MULTILINE|re.DOTALL)
+    __docstring_regex = re.compile(r'(class|def)(.+)\s+(("""[\s\S]*?""")|(\'\'\'[\s\S]*?\'\'\'))')
+
+    # Recently preprocessed code, shared by every instance (e.g. the classifier
+    # and progress model pipelines both preprocess each request's code)
+    __memo = LRUCache(4096)
+    # Larger batches (e.g. training data) aren't memoized, so they don't evict
+    # the code of recent requests
+    __memo_max_batch = 16
+
     def fit(self, X, y=None):
         return self
 
     def transform(self, X, y=None):
-        return np.array([self.remove_comments_and_docstring(x) for x in X])
+        # X may be any iterable, e.g. a generator
+        X = list(X)
+        memoize = len(X) <= PythonPreprocessor.__memo_max_batch
+        # Identical code (e.g. repeated submissions) is only preprocessed once
+        stripped = {}
+        for x in X:
+            if x not in stripped:
+                stripped[x] = self.remove_comments_and_docstring(x) if memoize else self.__remove(x)
+        return np.array([stripped[x] for x in X])
+
+    @staticmethod
+    def __replace_comment(match):
+        # if the 2nd group (capturing comments) is not None,
+        # it means we have captured a non-quoted (real) comment string.
+        if match.group(2) is not None:
+            return "" # so we will return empty to remove the comment
+        else: # otherwise, we will return the 1st group
+            return match.group(1) # captured quoted-string
 
     @staticmethod
     def __remove_via_regex(source: str) -> str:
-        pattern = r"(\".*?(?<!\\)\"|\'.*?(?<!\\)\')|(/\*.*?\*/|//[^\r\n]*$)"
-        # first group captures quoted strings (double or single)
-        # second group captures comments (//single-line or /* multi-line */)
-        regex = re.compile(pattern, re.MULTILINE|re.DOTALL)
-        def _replacer(match):
-            # if the 2nd group (capturing comments) is not None,
-            # it means we have captured a non-quoted (real) comment string.
-            if match.group(2) is not None:
-                return "" # so we will return empty to remove the comment
-            else: # otherwise, we will return the 1st group
-                return match.group(1) # captured quoted-string
-
-        # Remove comments
-        source = regex.sub(_replacer, source)
-        # Remove triple-quoted strings (docstrings)
-        source = re.sub(r'(class|def)(.+)\s+(("""[\s\S]*?""")|(\'\'\'[\s\S]*?\'\'\'))', r'\1\2', source)
+        # Both patterns need quotes or slashes to match, so most partial code can skip them
+        if '"' in source or "'" in source or '/' in source:
+            # Remove comments
+            source = PythonPreprocessor.__comment_regex.sub(PythonPreprocessor.__replace_comment, source)
+        if '"""' in source or "'''" in source:
+            # Remove triple-quoted strings (docstrings)
+            source = PythonPreprocessor.__docstring_regex.sub(r'\1\2', source)
         return source
 
     @staticmethod
@@ -66,6 +88,15 @@ class PythonPreprocessor(BaseEstimator, TransformerMixin):
 
     @staticmethod
     def remove_comments_and_docstring(source: str) -> str:
+        key = hashlib.blake2b(source.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+        stripped = PythonPreprocessor.__memo.get(key)
+        if stripped is None:
+            stripped = PythonPreprocessor.__remove(source)
+            PythonPreprocessor.__memo.put(key, stripped)
+        return stripped
+
+    @staticmethod
+    def __remove(source: str) -> str:
         # TODO: The parsing stripper also does something weird with
         # spacing that I don't like, so I'm not using it for now
         # try:
@@ -75,6 +106,10 @@ class PythonPreprocessor(BaseEstimator, TransformerMixin):
         stripped = stripped.replace("\t", "    ")
         return stripped
 
+    @staticmethod
+    def memo_stats():
+        return PythonPreprocessor.__memo.stats()
+
     @staticmethod
     def run_tests():
         for i, test in enumerate(tests):
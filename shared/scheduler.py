@@ -0,0 +1,90 @@
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+class BuildScheduler:
+    """ Runs model builds on a background thread pool, so that they never block
+    the request that triggered them. Builds are keyed (e.g. by ProblemID):
+    a request for a key that is already queued is merged into the queued build,
+    and a request for a key that is currently building schedules exactly one
+    more build once it finishes, so that it sees the newest data.
+    """
+
+    def __init__(self, build_function, max_concurrent_builds=1):
+        self.build_function = build_function
+        self.max_concurrent_builds = max_concurrent_builds
+        self.completed = 0
+        self.failed = 0
+        self.merged = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrent_builds, thread_name_prefix="aif-build")
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._queued = set()
+        self._running = set()
+        self._rerun = set()
+
+    def request_build(self, key):
+        """ Schedules a build for the given key, returning False if the request
+        was merged into a build that is already queued or running.
+        """
+        with self._lock:
+            if key in self._queued:
+                self.merged += 1
+                return False
+            if key in self._running:
+                self._rerun.add(key)
+                self.merged += 1
+                return False
+            self._queued.add(key)
+        self._executor.submit(self._run, key)
+        return True
+
+    def _run(self, key):
+        with self._lock:
+            self._queued.discard(key)
+            self._running.add(key)
+        try:
+            self.build_function(key)
+            succeeded = True
+        except Exception:
+            print(f"Background build failed for {key}")
+            traceback.print_exc()
+            succeeded = False
+        with self._lock:
+            self._running.discard(key)
+            if succeeded:
+                self.completed += 1
+            else:
+                self.failed += 1
+            rerun = key in self._rerun
+            if rerun:
+                self._rerun.discard(key)
+                self._queued.add(key)
+            self._idle.notify_all()
+        if rerun:
+            self._executor.submit(self._run, key)
+
+    def is_building(self, key):
+        with self._lock:
+            return key in self._queued or key in self._running
+
+    def wait(self, timeout=None):
+        """ Blocks until all queued and running builds have finished.
+        """
+        with self._lock:
+            return self._idle.wait_for(
+                lambda: len(self._queued) == 0 and len(self._running) == 0, timeout)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": len(self._queued),
+                "running": len(self._running),
+                "completed": self.completed,
+                "failed": self.failed,
+                "merged": self.merged,
+            }
@@ -0,0 +1,92 @@
+import os
+import json
+import tempfile
+from urllib.parse import quote
+import numpy as np
+
+SNAPSHOT_SUFFIX = '.npz'
+SNAPSHOT_FORMAT_VERSION = 1
+
+class TrainingSnapshot:
+    """ A problem's training submissions (code and scores), stored on disk in a
+    compact columnar form, along with the largest EventIDs that have been read
+    (the watermark), so that only newer events need to be read to update it.
+
+    The query describes which submissions were read (e.g. the problem and event
+    types), and a snapshot is only reused if it was created by the same query.
+    """
+
+    def __init__(self, query, codes=None, scores=None, watermark=None):
+        self.query = query
+        self.codes = list(codes) if codes is not None else []
+        self.scores = np.asarray(scores if scores is not None else [], dtype=np.float64)
+        self.watermark = watermark
+
+    @staticmethod
+    def path_for(directory, problem_id):
+        return os.path.join(directory, quote(str(problem_id), safe='') + SNAPSHOT_SUFFIX)
+
+    def is_valid_for(self, query, max_event_ids):
+        if self.query != query or self.watermark is None or max_event_ids is None:
+            return False
+        if len(self.watermark) != len(max_event_ids):
+            return False
+        # A database with fewer events than we've read must have been replaced
+        return all(seen <= latest for seen, latest in zip(self.watermark, max_event_ids))
+
+    def append(self, codes, scores, watermark):
+        """ Appends newly read submissions, where watermark has the largest
+        EventID that has now been read from each source.
+        """
+        self.codes.extend(codes)
+        self.scores = np.concatenate([self.scores, np.asarray(scores, dtype=np.float64)])
+        self.watermark = list(watermark)
+
+    @staticmethod
+    def load(path):
+        """ Returns the snapshot saved at the given path, or None if there isn't
+        a readable one.
+        """
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                metadata = json.loads(str(data['metadata']))
+                if metadata.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+                    return None
+                code_bytes = data['code_bytes'].tobytes()
+                offsets = data['code_offsets']
+                codes = [code_bytes[offsets[i]:offsets[i + 1]].decode('utf-8', 'surrogatepass')
+                         for i in range(len(offsets) - 1)]
+                return TrainingSnapshot(metadata['query'], codes, data['scores'], metadata['watermark'])
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Ignoring unreadable training snapshot {path}: {e}")
+            return None
+
+    def save(self, path):
+        # Code is stored as one UTF-8 buffer, with the offset of each string
+        encoded = [code.encode('utf-8', 'surrogatepass') for code in self.codes]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(code) for code in encoded], out=offsets[1:])
+        metadata = {
+            'format_version': SNAPSHOT_FORMAT_VERSION,
+            'query': self.query,
+            'watermark': self.watermark,
+        }
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # Written to a temporary file and renamed, so readers never see a partial snapshot
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                np.savez(
+                    file,
+                    metadata=np.array(json.dumps(metadata)),
+                    code_bytes=np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                    code_offsets=offsets,
+                    scores=self.scores,
+                )
+            os.replace(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise